@@ -33,6 +33,8 @@
 
 import datetime
 import os, sys, signal, re, argparse, pathlib, time, subprocess
+import concurrent.futures, threading, json, hashlib, shutil, queue, itertools, atexit
+import math, statistics, ctypes, struct, random, csv
 import src.common as common
 from src.common import *
 
@@ -43,8 +45,17 @@ ENABLE_SEQUENTIAL = False
 
 ENABLE_FASTSCAN = True
 
+# do the initial scan with seccomp-run's discovery mode instead of strace
+BUILTIN_TRACER = False
+
 ENABLE_STATIC = True
 
+# without the strace scan, only probe the system calls that the static
+# analyser finds in the binary (see --static-prune); the others are deemed
+# unused once STATIC_PRUNE_SAMPLE of them, picked at random, are confirmed so
+STATIC_PRUNE = False
+STATIC_PRUNE_SAMPLE = 10
+
 ENABLE_FINAL_CHECK = False
 
 PARTIAL_SUPPORT_ANALYSIS = False
@@ -59,13 +70,32 @@ TASKSET_CPU = 5
 WARMUP_ROUNDS = 5
 # how many runs to average
 NO_RUNS_AVG = 4
+# with --perf-ci, sample until the 95% confidence interval of the mean is
+# within +/- PERF_CI of the mean (relative), with at least PERF_MIN_RUNS and
+# at most PERF_MAX_RUNS runs; otherwise do NO_RUNS_AVG runs
+PERF_CI = None
+PERF_MIN_RUNS = 3
+PERF_MAX_RUNS = 30
+# the baseline is warmed up when the relative standard deviation of the last
+# NO_RUNS_AVG runs is below this (or below PERF_CI if set)
+PERF_STABLE_CV = 0.05
 # How many times we re-run a failing test before conluding that it does fail
 LIMIT_RETRIES = 2
+# before retrying, wait for the failed run to release its resources, polling
+# with exponential backoff starting at RETRY_BACKOFF_START (doubled at each
+# retry of the same probe) and for at most RETRY_MAX_WAIT seconds
+RETRY_BACKOFF_START = 0.05
+RETRY_MAX_WAIT = 10
 
 BEAUTIFY_PERF_OUTPUT = True
 
 WAIT_STARTUP_TIME = 0.40
 
+# how to detect that the program is ready to be tested, as a (kind, argument)
+# tuple (see --ready-on); if None, we just sleep WAIT_STARTUP_TIME
+READY_PROBE = None
+READY_POLL_INTERVAL = 0.01
+
 # NOTE: adapt timeout depending on how long your script takes...
 TEST_TIMEOUT = 4
 
@@ -76,11 +106,45 @@ SECCOMPRUN_PATH = os.path.join(HOME_PATH, "src", "seccomp-run")
 
 SMART_WAIT_REPEAT = 1
 
+# how many probes to run concurrently; > 1 only makes sense if several
+# instances of the program can run side by side (no fixed port, etc.)
+JOBS = 1
+
+# probe batches of system calls and only bisect batches that fail
+GROUP_TESTING = False
+
+# stop a probe as soon as the program dies of a signal or exits with an
+# error, instead of waiting for the test script to fail or time out
+EARLY_ABORT = True
+
+# have seccomp-run decide path (-t) stubbing from the seccomp user
+# notification fd instead of stopping the program with ptrace at every
+# filtered system call (partial stubbing, -p, is decided by the filter
+# itself, and -y only stops the program at execs); None means use it if the
+# kernel supports it
+USER_NOTIF = None
+
+# have seccomp-run count how many times the probed system calls are stubbed
+# (see --hit-accounting): a probe that works without ever calling them tells
+# nothing about them; with RERUN_UNHIT, such probes are run once more; with
+# HIT_LOG_PATH, the counts of every probe are appended there as CSV
+HIT_ACCOUNTING = False
+RERUN_UNHIT = False
+HIT_LOG_PATH = None
+
 # =========
 # CONSTANTS
 
 ERRNO_ENOSYS = 38
 
+# resource usage metrics reported alongside perf, openfds and memusage
+RESOURCE_METRICS = ["tree_openfds", "tree_memusage", "cpu_time", "ctx_switches",
+                    "instructions", "cycles", "page_faults"]
+
+# the baseline for the performance analysis stubs seccomp (already set up by
+# seccomp-run by the time the program runs)
+BASELINE_SYSCALL = 317
+
 # edit this if you want to use strace from another location
 STRACE_BINARY = "strace"
 
@@ -106,9 +170,17 @@ SYSCALL_FLAGS_FILES = {
 
 INITIAL_SCAN_STDERR = "/tmp/dynsystmp"
 INITIAL_SCAN_STDOUT = "/tmp/dynsystmp-stdout"
+INITIAL_SCAN_DISCOVERY = "/tmp/dynsystmp-discovery"
 
 CSV_OPT = "--output-csv"
 
+# what start_test_cmd() returns when the test script times out (as timeout(1))
+TEST_TIMEOUT_RET = 124
+
+# what start_test_cmd() returns when the program failed before the test
+# script could conclude
+TARGET_FAILED_RET = 125
+
 # ============
 # USAGE CHECKS
 
@@ -127,13 +199,6 @@ def strace_recent_enough():
         return False
     return True
 
-if not strace_recent_enough():
-    print("WARN: strace is old on this system and does not support -n")
-    print("      without support for this option, the scan will be MUCH slower")
-    print("      you can get a proper recent strace from https://strace.io/")
-    input("[ press ENTER to continue, or kill me to abort (CTRL-C) ]")
-    ENABLE_FASTSCAN = False
-
 # =======
 # HELPERS
 
@@ -153,65 +218,994 @@ def smart_wait(process, logfs):
                 break
     return ret
 
-def cleanup():
+# return True if something listens on TCP port in the network namespace of pid
+def tcp_port_listening(port, pid="self"):
+    for proto in ["tcp", "tcp6"]:
+        try:
+            with open("/proc/%s/net/%s" % (str(pid), proto)) as netf:
+                next(netf) # header
+                for line in netf:
+                    fields = line.split()
+                    # fields[3] is the socket state, 0A is LISTEN
+                    if (int(fields[1].split(":")[1], 16) == port and
+                        fields[3] == "0A"):
+                        return True
+        except(OSError):
+            pass
+    return False
+
+# return True if something listens on Unix socket path in the network
+# namespace of pid
+def unix_socket_listening(path, pid="self"):
+    try:
+        with open("/proc/%s/net/unix" % str(pid)) as netf:
+            next(netf) # header
+            for line in netf:
+                fields = line.split()
+                # flag 0x10000 is __SO_ACCEPTCON, i.e., listening
+                if (len(fields) >= 8 and fields[7] == path and
+                    int(fields[3], 16) & 0x10000):
+                    return True
+    except(OSError):
+        pass
+    return False
+
+def parse_ready_probe(spec):
+    if spec == "exit":
+        return ("exit", None)
+    (kind, sep, arg) = spec.partition(":")
+    if not sep or not arg:
+        return None
+    if kind == "tcp":
+        try:
+            return (kind, int(arg))
+        except(ValueError):
+            return None
+    if kind == "log":
+        try:
+            return (kind, re.compile(arg))
+        except(re.error):
+            return None
+    if kind in ["unix", "pidfile"]:
+        return (kind, arg)
+    return None
+
+# wait until the program is ready to be tested according to READY_PROBE, or
+# until it dies; return True if it is ready, False on timeout or death
+def wait_ready(process, logfs):
+    (kind, arg) = READY_PROBE
+    deadline = time.time() + TEST_TIMEOUT
+    logpos = 0
+    logtail = ""
+
+    while True:
+        if kind == "exit":
+            if process.poll() is not None:
+                return True
+        elif process.poll() is not None:
+            # no need to wait for a dead program
+            return False
+        elif kind == "tcp":
+            if tcp_port_listening(arg, process.pid):
+                return True
+        elif kind == "unix":
+            if unix_socket_listening(arg, process.pid):
+                return True
+        elif kind == "pidfile":
+            if os.path.exists(arg):
+                return True
+        elif kind == "log":
+            with open(logfs, "rb") as logf:
+                logf.seek(logpos)
+                data = logf.read().decode("utf-8", errors="replace")
+                logpos = logf.tell()
+            # only keep the last (incomplete) line around
+            lines = (logtail + data).split("\n")
+            logtail = lines[-1]
+            for line in lines:
+                if arg.search(line):
+                    return True
+
+        if time.time() > deadline:
+            return False
+        time.sleep(READY_POLL_INTERVAL)
+
+# do not mistake the pid file of a previous run for readiness
+def remove_stale_pidfile():
+    if READY_PROBE is not None and READY_PROBE[0] == "pidfile":
+        try:
+            os.remove(READY_PROBE[1])
+        except(FileNotFoundError):
+            pass
+
+# give the program time to initialize before testing it
+def wait_startup(process, logfs):
+    if READY_PROBE is None:
+        deadline = time.time() + WAIT_STARTUP_TIME
+        while time.time() < deadline and not target_failed(process):
+            time.sleep(max(0, min(READY_POLL_INTERVAL, deadline - time.time())))
+        return True
+    return wait_ready(process, logfs)
+
+def cleanup(force=False):
+    # with concurrent probes, killing every instance of the binary would also
+    # kill sibling probes; each probe tears down its own process group instead
+    # (the supervisor also takes care of processes escaping the group)
+    if (JOBS > 1 or ENABLE_SUPERVISOR or ENABLE_CGROUPS) and not force:
+        return
     # make sure to have a clean system
     os.system("killall -9 %s > /dev/null 2>&1" % binary_path)
     os.system("pkill -9 %s > /dev/null 2>&1" % binary_path)
 
+# ===============
+# CGROUP TRACKING
+
+# put every probe (program and test script) in its own cgroup v2, tear it
+# down with cgroup.kill and read its resource usage from the cgroup (see
+# --cgroups)
+ENABLE_CGROUPS = False
+CGROUP_ROOT = None
+CGROUP_IDS = itertools.count()
+CGROUP_CONTROLLERS = ["memory", "cpu"]
+
+def cgroup2_mount():
+    with open("/proc/self/mounts") as mounts:
+        for line in mounts:
+            fields = line.split()
+            if fields[2] == "cgroup2":
+                return fields[1]
+    return None
+
+# enable as many controllers as possible in the subtree of path; only the
+# core interface files (cgroup.kill, cpu.stat) are required
+def cgroup_enable_controllers(path):
+    for c in CGROUP_CONTROLLERS:
+        try:
+            with open(os.path.join(path, "cgroup.subtree_control"), "w") as f:
+                f.write("+" + c)
+        except(OSError):
+            pass
+
+# create <cgroup2 mount>/loupe/<our pid>, which will hold one cgroup per
+# probe; return False if cgroups cannot be used
+def cgroup_setup():
+    global CGROUP_ROOT
+    mount = cgroup2_mount()
+    if mount is None:
+        return False
+
+    # cgroups that have children cannot have processes, use the root's
+    # subtree so that we do not need to move ourselves; leave the root's
+    # controllers alone, they are host-wide state
+    parent = os.path.join(mount, "loupe")
+    try:
+        os.makedirs(parent, exist_ok=True)
+        cgroup_enable_controllers(parent)
+        CGROUP_ROOT = os.path.join(parent, str(os.getpid()))
+        os.mkdir(CGROUP_ROOT)
+        atexit.register(cgroup_teardown)
+        cgroup_enable_controllers(CGROUP_ROOT)
+    except(OSError) as e:
+        debug("Cannot create cgroups: %s" % e)
+        return False
+    return os.path.exists(os.path.join(CGROUP_ROOT, "cgroup.kill"))
+
+def cgroup_create():
+    path = os.path.join(CGROUP_ROOT, "probe-%d" % next(CGROUP_IDS))
+    os.mkdir(path)
+    return path
+
+# to be called in the child, before exec
+def cgroup_join(path):
+    with open(os.path.join(path, "cgroup.procs"), "w") as f:
+        f.write("0")
+
+def cgroup_populated(path):
+    try:
+        with open(os.path.join(path, "cgroup.events")) as f:
+            return "populated 1" in f.read()
+    except(FileNotFoundError):
+        return False
+
+# peak memory usage (kB, if the memory controller is available) and CPU time
+# (s) of everything that ran in the cgroup
+def cgroup_stats(path):
+    stats = {}
+    try:
+        with open(os.path.join(path, "memory.peak")) as f:
+            stats["memory_peak"] = int(f.read()) // 1024
+    except(OSError, ValueError):
+        pass
+    try:
+        with open(os.path.join(path, "cpu.stat")) as f:
+            for line in f:
+                (k, v) = line.split()
+                if k in ["usage_usec", "user_usec", "system_usec"]:
+                    stats["cpu_" + k[:-5]] = int(v) / 1000000
+    except(OSError, ValueError):
+        pass
+    return stats
+
+# kill everything in the cgroup, remove it and return its resource usage
+def cgroup_destroy(path):
+    with open(os.path.join(path, "cgroup.kill"), "w") as f:
+        f.write("1")
+
+    # processes leave the cgroup asynchronously
+    deadline = time.monotonic() + RETRY_MAX_WAIT
+    while cgroup_populated(path) and time.monotonic() < deadline:
+        time.sleep(0.001)
+
+    stats = cgroup_stats(path)
+    try:
+        os.rmdir(path)
+    except(OSError) as e:
+        warning("Cannot remove cgroup %s: %s" % (path, e))
+    return stats
+
+def cgroup_teardown():
+    if CGROUP_ROOT is None:
+        return
+    for d in os.listdir(CGROUP_ROOT):
+        if os.path.isdir(os.path.join(CGROUP_ROOT, d)):
+            cgroup_destroy(os.path.join(CGROUP_ROOT, d))
+    # the parent is shared with concurrent runs, only remove it when empty
+    for path in [CGROUP_ROOT, os.path.dirname(CGROUP_ROOT)]:
+        try:
+            os.rmdir(path)
+        except(OSError):
+            pass
+
+# ==================
+# NETWORK NAMESPACES
+
+# run every probe in its own network namespace, so that concurrent probes of
+# a program that listens on a fixed port do not collide (see --netns)
+ENABLE_NETNS = False
+
+# the loopback interface of a new namespace is down, bring it up first
+NETNS_PREFIX = ["unshare", "--net", "--", "sh", "-c",
+                "ip link set lo up && exec \"$@\"", "netns"]
+
+# run the test script in the namespace of the program; in sequential mode
+# the program is gone already, and the test only reads its output
+def netns_test_cmd(testcmd, process):
+    if not ENABLE_NETNS or ENABLE_SEQUENTIAL or not is_process(process):
+        return testcmd
+    return ["nsenter", "--net=/proc/%d/ns/net" % process.pid, "--"] + testcmd
+
+# ================
+# PROBE SUPERVISOR
+
+# start and tear down probes through a long-lived supervisor process
+# (src/probe-supervisor.c) instead of forking from Python and spawning shells
+# for killall/pkill at every probe (see --supervisor)
+ENABLE_SUPERVISOR = False
+SUPERVISOR_PATH = os.path.join(HOME_PATH, "src", "probe-supervisor")
+SUPERVISOR = None
+
+class Supervisor:
+    def __init__(self):
+        self.process = subprocess.Popen([SUPERVISOR_PATH], stdin=subprocess.PIPE,
+                stdout=subprocess.PIPE, text=True, bufsize=1)
+        self.lock = threading.Lock()
+        self.replies = {}
+        self.ids = itertools.count()
+        threading.Thread(target=self.read_replies, daemon=True).start()
+
+    # replies may come out of order, dispatch them by probe id
+    def read_replies(self):
+        for line in self.process.stdout:
+            fields = line.rstrip("\n").split("\t")
+            with self.lock:
+                q = self.replies.get(int(fields[1]))
+            if q is not None:
+                q.put(fields)
+
+        error("The probe supervisor died.")
+        with self.lock:
+            for q in self.replies.values():
+                q.put(["err", "-1", "supervisor died"])
+
+    # send a command and wait for the reply; there is at most one pending
+    # command per probe
+    def request(self, command, id, *args):
+        fields = [command, str(id)] + list(map(str, args))
+        for f in fields:
+            if "\t" in f or "\n" in f:
+                raise ValueError("cannot pass '%s' to the supervisor" % f)
+
+        q = queue.Queue()
+        with self.lock:
+            self.replies[id] = q
+            self.process.stdin.write("\t".join(fields) + "\n")
+            self.process.stdin.flush()
+        reply = q.get()
+        with self.lock:
+            del self.replies[id]
+        return reply
+
+# implements the parts of subprocess.Popen that we use, for a process
+# started by the supervisor
+class SupervisedProcess:
+    def __init__(self, args, log, cgroup=None):
+        self.args = list(map(str, args))
+        self.id = next(SUPERVISOR.ids)
+        self.returncode = None
+        # user/system time in seconds and max RSS in kB, once exited
+        self.rusage = None
+        self.released = False
+
+        if cgroup is None:
+            reply = SUPERVISOR.request("run", self.id, log, *self.args)
+        else:
+            reply = SUPERVISOR.request("runin", self.id, cgroup, log, *self.args)
+        if reply[0] != "ok":
+            raise OSError("cannot start %s: %s" % (self.args[0], reply[2]))
+        self.pid = int(reply[2])
+
+    def exited(self, reply):
+        if reply[0] != "exited":
+            raise OSError("lost track of %s: %s" % (self.args[0], reply[2]))
+        self.returncode = os.waitstatus_to_exitcode(int(reply[2]))
+        self.rusage = {"utime": int(reply[3]) / 1000000,
+                       "stime": int(reply[4]) / 1000000,
+                       "maxrss": int(reply[5])}
+
+    def wait(self, timeout=None):
+        if self.returncode is None:
+            ms = -1 if timeout is None else int(timeout * 1000)
+            reply = SUPERVISOR.request("wait", self.id, ms)
+            if reply[0] == "running":
+                raise subprocess.TimeoutExpired(self.args, timeout)
+            self.exited(reply)
+        return self.returncode
+
+    def poll(self):
+        try:
+            return self.wait(0)
+        except(subprocess.TimeoutExpired):
+            return None
+
+    # kill the whole process tree
+    def kill(self):
+        if self.released:
+            return
+        reply = SUPERVISOR.request("kill", self.id)
+        self.released = True
+        if self.returncode is None:
+            self.exited(reply)
+
+def is_process(process):
+    return isinstance(process, (subprocess.Popen, SupervisedProcess))
+
+# start a process in a new session with stdout/stderr to logf, in the given
+# cgroup if any
+def spawn(runcmd, logf, cgroup=None):
+    if ENABLE_SUPERVISOR:
+        process = SupervisedProcess(runcmd, logf.name, cgroup)
+    else:
+        def setup():
+            os.setsid()
+            if cgroup is not None:
+                cgroup_join(cgroup)
+        process = subprocess.Popen(runcmd, stderr=logf, stdout=logf,
+            preexec_fn=setup)
+    # the test script joins the cgroup of the program, kill_probe() tears
+    # it down
+    process.cgroup = cgroup
+    process.cgroup_stats = {}
+    return process
+
+# check once that seccomp-run can use the user notification fd here
+# (Linux >= 5.8), by stubbing a path that nobody opens
+def user_notif_supported():
+    global USER_NOTIF
+    if USER_NOTIF is None:
+        try:
+            ret = subprocess.run([SECCOMPRUN_PATH, "-q", "-u", "-e", str(ERRNO_ENOSYS),
+                        "-t", "1", "/nonexistent", "-n", "1", "257", "--", "/bin/true"],
+                        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                        timeout=TEST_TIMEOUT)
+            USER_NOTIF = (ret.returncode == 0)
+        except subprocess.TimeoutExpired:
+            USER_NOTIF = False
+        if not USER_NOTIF:
+            warning("seccomp user notifications unsupported, path stubbing " +
+                    "will use ptrace (much slower).")
+    return USER_NOTIF
+
+# the options only select a faster seccomp-run backend, they are not part of
+# the probe description (cache and journal keys)
+def seccomp_run_backend(opts):
+    if "-t" in opts and user_notif_supported():
+        return ["-u"]
+    return []
+
 def start_seccomp_run(errno, syscalls, logf, prefix=[], opts=[]):
     cleanup()
 
     runcmd = []
+    if ENABLE_NETNS and ZBINARY is None:
+        runcmd.extend(NETNS_PREFIX)
     runcmd.extend(prefix)
     runcmd.extend([SECCOMPRUN_PATH, "-e", errno, "-n", str(len(syscalls))])
     runcmd.extend(list(map(str, syscalls)))
     if ZBINARY is not None:
         runcmd.extend(["-y", ''.join(ZBINARY)])
+    if HIT_ACCOUNTING:
+        runcmd.extend(["-c", hits_path(logf.name)])
     runcmd.extend(opts)
+    runcmd.extend(seccomp_run_backend(opts))
     runcmd.extend(["--", str(binary_path)])
     runcmd.extend(binary_options)
 
-    if ZBINARY is not None:
-        try:
-            ret = subprocess.run(runcmd, timeout=TEST_TIMEOUT, stdout=logf, stderr=logf,
-                preexec_fn=os.setsid)
-        except:
-            ret = -1
-    else:
+    remove_stale_pidfile()
 
-        ret = subprocess.Popen(runcmd, stderr=logf, stdout=logf,
-            preexec_fn=os.setsid)
+    cgroup = cgroup_create() if ENABLE_CGROUPS else None
+    ret = spawn(runcmd, logf, cgroup)
 
-    # small sleep in case the program needs time to initialize
-    time.sleep(WAIT_STARTUP_TIME)
+    # in case the program needs time to initialize
+    wait_startup(ret, logf.name)
 
     return ret
 
-def start_test_cmd(log, test_log):
+# return True if the program died of a signal or exited with an error while
+# it should be serving the test; there is no need to wait for the test
+# script then (see --no-early-abort)
+def target_failed(process):
+    return EARLY_ABORT and not ENABLE_SEQUENTIAL and probe_crashed(process)
+
+# what the test returns when the program failed before or during the test
+def target_failed_ret():
+    port = stale_port()
+    if port is not None and tcp_port_listening(port):
+        # most likely the port of a previous run is not free yet, the test
+        # script would have asked for a retry
+        return 200
+    return TARGET_FAILED_RET
+
+# wait for the test script, or until the program fails
+def wait_test(test, process):
+    deadline = time.time() + TEST_TIMEOUT
+    while True:
+        try:
+            ret = test.wait(timeout=max(0, min(READY_POLL_INTERVAL,
+                                               deadline - time.time())))
+            break
+        except(subprocess.TimeoutExpired):
+            pass
+        if target_failed(process):
+            ret = target_failed_ret()
+            break
+        if time.time() > deadline:
+            ret = TEST_TIMEOUT_RET
+            break
+    # also releases a supervised test script
+    test.kill()
+    test.wait()
+    return ret
+
+def start_test_cmd(log, test_log, process=None):
+    if target_failed(process):
+        return target_failed_ret()
     if testscript_path is None:
-        time.sleep(TEST_TIMEOUT)
+        # without a test script, being ready is the test
+        if READY_PROBE is not None and is_process(process):
+            return 0 if wait_ready(process, log) else 1
+        deadline = time.time() + TEST_TIMEOUT
+        while time.time() < deadline:
+            if target_failed(process):
+                return target_failed_ret()
+            time.sleep(READY_POLL_INTERVAL)
         return 0
-    testcmd = [testscript_path, log]
-    ret = 0
+    testcmd = netns_test_cmd([testscript_path, log], process)
+    cgroup = getattr(process, "cgroup", None)
+    with open(test_log, "w+") as test_logfile:
+        if ENABLE_SUPERVISOR:
+            test = spawn(testcmd, test_logfile, cgroup)
+        else:
+            test = subprocess.Popen(testcmd, stdout=test_logfile,
+                stderr=subprocess.STDOUT,
+                preexec_fn=None if cgroup is None else lambda: cgroup_join(cgroup))
+    return wait_test(test, process)
+
+def kill_probe(process):
+    if getattr(process, "cgroup", None) is not None:
+        process.cgroup_stats = cgroup_destroy(process.cgroup)
+        process.cgroup = None
+    if isinstance(process, SupervisedProcess):
+        process.kill()
+        return
+    try:
+        # seccomp-run is started with setsid, its pid is the process group
+        os.killpg(process.pid, signal.SIGKILL)
+    except(ProcessLookupError):
+        pass
+    process.wait()
+
+# ================
+# RETRY MANAGEMENT
+
+# (probe description, failure cause) -> number of retries
+RETRY_COUNTS = {}
+RETRY_LOCK = threading.Lock()
+
+# return True if the program died on its own
+def probe_crashed(process):
+    return is_process(process) and process.poll() not in [None, 0]
+
+# return True if a process group still has live (non-zombie) members
+def pgroup_alive(pgid):
+    for pid in os.listdir("/proc"):
+        if not pid.isdigit():
+            continue
+        try:
+            with open("/proc/%s/stat" % pid) as statf:
+                # the command name may contain spaces, skip past it
+                fields = statf.read().rpartition(")")[2].split()
+        except(OSError):
+            continue
+        if int(fields[2]) == pgid and fields[0] != "Z":
+            return True
+    return False
+
+# the port that the program listens on, if we know it
+def probe_port():
+    if READY_PROBE is not None and READY_PROBE[0] == "tcp":
+        return READY_PROBE[1]
+    return None
+
+# the port that a previous run of the program may still hold in our network
+# namespace, if we know it; with --netns, each run has its own namespace,
+# and with --jobs, the port is held by sibling probes (which says nothing
+# about this one)
+def stale_port():
+    if JOBS > 1 or ENABLE_NETNS:
+        return None
+    return probe_port()
+
+# tear down a failed run, determine why it failed, and wait until whatever
+# blocks a new run is released; return the failure cause
+def retry_after_failure(process, crashed, test_ret, what, errs):
+    kill_probe(process)
+    cleanup()
+
+    port = stale_port()
+    if port is not None and tcp_port_listening(port):
+        cause = "port still bound"
+    elif crashed:
+        cause = "target crashed"
+    elif test_ret == TEST_TIMEOUT_RET:
+        cause = "test timeout"
+    else:
+        cause = "test failure"
+
+    def released():
+        if is_process(process) and pgroup_alive(process.pid):
+            return False
+        if port is not None and tcp_port_listening(port):
+            return False
+        return True
+
+    delay = RETRY_BACKOFF_START
+    waited = 0
+    # back off more for probes that keep failing
+    mindelay = RETRY_BACKOFF_START * (2 ** errs)
+    while (waited < mindelay or not released()) and waited < RETRY_MAX_WAIT:
+        time.sleep(delay)
+        waited += delay
+        delay = min(delay * 2, RETRY_MAX_WAIT - waited)
+
+    debug("Retrying %s (%s), waited %.2fs" % (what, cause, waited))
+    with RETRY_LOCK:
+        RETRY_COUNTS[(what, cause)] = RETRY_COUNTS.get((what, cause), 0) + 1
+    return cause
+
+def report_retries():
+    if not len(RETRY_COUNTS):
+        return
+    info("Probes that had to be retried:")
+    for ((what, cause), n) in sorted(RETRY_COUNTS.items()):
+        info("  %s: %d retries (%s)" % (what, n, cause))
+
+def describe_probe(errno, syscalls, opts=[]):
+    desc = "errno %s, syscalls %s" % (errno,
+            ",".join(map(str, format_syscall_list(list(syscalls)))))
+    if len(opts):
+        desc += " (%s)" % " ".join(opts)
+    return desc
+
+# ==============
+# HIT ACCOUNTING
+
+# probes that worked without hitting their system calls, as (errno,
+# syscalls, opts) tuples
+UNHIT_PROBES = []
+UNHIT_LOCK = threading.Lock()
+
+def hits_path(log):
+    return log + ".hits"
+
+# return {syscall: hits} as counted by seccomp-run (-c) during the last run
+# of the probe logged to log, None if it was not counted
+def read_hits(log):
+    if not HIT_ACCOUNTING:
+        return None
+    hits = {}
+    try:
+        with open(hits_path(log)) as hitsf:
+            for line in hitsf:
+                (nr, n) = line.split()
+                hits[int(nr)] = int(n)
+    except (OSError, ValueError):
+        return None
+    return hits
+
+def probe_unhit(log):
+    hits = read_hits(log)
+    return hits is not None and sum(hits.values()) == 0
+
+# one CSV row per counted run of a probe; syscalls, opts and hits
+# ("<syscall>:<hits>") are space-separated lists
+def log_hits(errno, syscalls, opts, outcome, hits):
+    if HIT_LOG_PATH is None or hits is None:
+        return
+    row = [CURRENT_PHASE, errno, " ".join(map(str, syscalls)), " ".join(opts),
+           outcome, " ".join(["%d:%d" % h for h in sorted(hits.items())]),
+           "Y" if outcome == "works" and sum(hits.values()) == 0 else "N"]
+    with UNHIT_LOCK:
+        new = not os.path.exists(HIT_LOG_PATH)
+        with open(HIT_LOG_PATH, "a", newline="") as hitlogf:
+            writer = csv.writer(hitlogf)
+            if new:
+                writer.writerow(["# phase", "errno", "syscalls", "opts",
+                                 "outcome", "hits", "unhit"])
+            writer.writerow(row)
+
+def record_unhit(errno, syscalls, opts):
+    with UNHIT_LOCK:
+        UNHIT_PROBES.append((errno, syscalls, opts))
+
+def report_unhit():
+    if not len(UNHIT_PROBES):
+        return
+    warning("%d probe(s) worked without ever calling the system calls they " \
+            "stub; their results depend on the test covering them:" % len(UNHIT_PROBES))
+    for (errno, syscalls, opts) in UNHIT_PROBES:
+        info("  %s" % describe_probe(errno, syscalls, opts))
+
+# ===========
+# RUN JOURNAL
+
+# append-only log of completed probes, one JSON record per line, so that an
+# interrupted run can be resumed (see --journal and --resume)
+JOURNAL_PATH = None
+JOURNAL = {}
+JOURNAL_LOCK = threading.Lock()
+
+def journal_key(kind, errno, syscalls, opts=[]):
+    return json.dumps([kind, str(errno), list(syscalls), list(opts)])
+
+# the command line of the run, as far as results are concerned
+def journal_cmd():
+    return [a for a in sys.argv[1:] if a != "--resume"]
+
+def journal_open(path, resume):
+    global JOURNAL_PATH
+    JOURNAL_PATH = path
+
+    if resume and os.path.exists(path):
+        with open(path) as journalf:
+            for line in journalf:
+                try:
+                    record = json.loads(line)
+                except(ValueError):
+                    # last record may be truncated if we died writing it
+                    continue
+                if record["kind"] == "header":
+                    if record["cmd"] != journal_cmd():
+                        warning("Resuming a journal created with different " +
+                                "arguments: %s" % " ".join(record["cmd"]))
+                    continue
+                JOURNAL[journal_key(record["kind"], record["errno"],
+                        record["syscalls"], record["opts"])] = record["outcome"]
+        info("Resuming from %s, %d probes already done" % (path, len(JOURNAL)))
+        return
+
+    with open(path, "w") as journalf:
+        journalf.write(json.dumps({"kind": "header", "cmd": journal_cmd()}) + "\n")
+
+# return the outcome of a probe from the journal, None if it was not done yet
+def journal_lookup(kind, errno, syscalls, opts=[]):
+    return JOURNAL.get(journal_key(kind, errno, syscalls, opts))
+
+def journal_record(kind, errno, syscalls, opts, outcome):
+    if JOURNAL_PATH is None:
+        return
+    record = json.dumps({"kind": kind, "errno": str(errno),
+            "syscalls": list(syscalls), "opts": list(opts), "outcome": outcome})
+    with JOURNAL_LOCK:
+        JOURNAL[journal_key(kind, errno, syscalls, opts)] = outcome
+        with open(JOURNAL_PATH, "a") as journalf:
+            journalf.write(record + "\n")
+            # the point is to survive crashes and container restarts
+            journalf.flush()
+            os.fsync(journalf.fileno())
+
+# ============
+# PROBE CACHE
+
+# on-disk cache of probe outcomes shared across runs, keyed by everything
+# that determines the outcome of a probe (see cache_key; files are identified
+# by their get_file_hash(), the key is the SHA-256 of it all)
+ENABLE_CACHE = True
+CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "loupe", "probes")
+# least recently used entries are evicted beyond this
+CACHE_MAX_ENTRIES = 200000
+
+CACHE_CONTEXT = None
+CACHE_LOCK = threading.Lock()
+
+def hash_file_or_name(path):
+    if path is None:
+        return None
+    resolved = shutil.which(str(path))
+    if resolved is None:
+        return str(path)
+    return get_file_hash(resolved)
+
+# hash of everything that is the same for all probes of this run
+def cache_context():
+    global CACHE_CONTEXT
+    with CACHE_LOCK:
+        if CACHE_CONTEXT is None:
+            CACHE_CONTEXT = json.dumps([
+                hash_file_or_name(binary_path), list(map(str, binary_options)),
+                hash_file_or_name(testscript_path), hash_file_or_name(ZBINARY),
+                hash_file_or_name(SECCOMPRUN_PATH), TEST_TIMEOUT,
+                ENABLE_SEQUENTIAL, SMART_WAIT_REPEAT, str(READY_PROBE),
+                EARLY_ABORT, ENABLE_NETNS])
+    return CACHE_CONTEXT
+
+def cache_key(errno, syscalls, opts, snapshot):
+    key = json.dumps([cache_context(), str(errno), list(syscalls), list(opts),
+                      snapshot])
+    return hashlib.sha256(key.encode("utf-8")).hexdigest()
+
+def cache_path(key):
+    return os.path.join(CACHE_DIR, key[:2], key + ".json")
+
+def cache_lookup(errno, syscalls, opts, snapshot=False):
+    if not ENABLE_CACHE:
+        return None
+    path = cache_path(cache_key(errno, syscalls, opts, snapshot))
     try:
-        with open(test_log, "w+") as test_logfile:
-          ret = subprocess.call(testcmd, stdout=test_logfile,
-             stderr=subprocess.STDOUT, timeout=TEST_TIMEOUT)
-    except(subprocess.TimeoutExpired):
-        ret = 1
+        with open(path) as cachef:
+            used = json.load(cachef)["used"]
+    except(OSError, ValueError, KeyError):
+        return None
+    # mark as recently used
+    os.utime(path)
+    return used
+
+def cache_store(errno, syscalls, opts, used, snapshot=False):
+    if not ENABLE_CACHE:
+        return
+    path = cache_path(cache_key(errno, syscalls, opts, snapshot))
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    # write and rename, so that readers never see a partial entry
+    tmp = "%s.%d.%d" % (path, os.getpid(), threading.get_ident())
+    with open(tmp, "w") as cachef:
+        json.dump({"used": used}, cachef)
+    os.rename(tmp, path)
+
+def cache_evict():
+    if not ENABLE_CACHE or not os.path.isdir(CACHE_DIR):
+        return
+    entries = []
+    for (root, dirs, files) in os.walk(CACHE_DIR):
+        for f in files:
+            path = os.path.join(root, f)
+            try:
+                entries.append((os.stat(path).st_mtime, path))
+            except(OSError):
+                pass
+    if len(entries) <= CACHE_MAX_ENTRIES:
+        return
+    entries.sort()
+    for (mtime, path) in entries[:len(entries) - CACHE_MAX_ENTRIES]:
+        try:
+            os.remove(path)
+        except(OSError):
+            pass
+    debug("Evicted %d probe cache entries" % (len(entries) - CACHE_MAX_ENTRIES))
+
+# =============
+# SNAPSHOT MODE
+
+# restore the program from a CRIU snapshot taken once it is initialized
+# instead of starting it from scratch for every probe (see --snapshot)
+ENABLE_SNAPSHOT = False
+CRIU_BINARY = "criu"
+SNAPSHOT_DIR = None
+SNAPSHOT_PID = None
+SNAPSHOT_LOCK = threading.Lock()
+
+# system calls that the strace scan saw before the program was ready; a
+# snapshot taken after initialization tells us nothing about these
+STARTUP_SYSCALLS = None
+
+def create_snapshot():
+    global SNAPSHOT_DIR, SNAPSHOT_PID, ENABLE_SNAPSHOT
+
+    cleanup()
+    remove_stale_pidfile()
+    snapdir = get_temp_dir()
+    # the restored program keeps writing to this file, not to the probe log
+    targetlog = os.path.join(snapdir, "target.log")
+
+    runcmd = [str(binary_path)]
+    runcmd.extend(binary_options)
+    with open(targetlog, "wb") as logf:
+        process = subprocess.Popen(runcmd, stdin=subprocess.DEVNULL,
+                stdout=logf, stderr=logf, preexec_fn=os.setsid)
+
+    if wait_startup(process, targetlog) and process.poll() is None:
+        dumpcmd = [CRIU_BINARY, "dump", "--tree", str(process.pid),
+                   "--images-dir", snapdir, "--shell-job", "--tcp-established",
+                   "--log-file", "dump.log"]
+        ret = subprocess.call(dumpcmd, stdout=subprocess.DEVNULL,
+                stderr=subprocess.DEVNULL)
+    else:
+        ret = -1
+
+    # criu dump kills the program, but in case it failed...
+    kill_probe(process)
+
+    if ret != 0:
+        warning("Could not create a snapshot of the program, disabling " +
+                "snapshot mode (see %s)." % os.path.join(snapdir, "dump.log"))
+        ENABLE_SNAPSHOT = False
+        return
+
+    SNAPSHOT_DIR = snapdir
+    SNAPSHOT_PID = process.pid
+    info("Snapshot of the initialized program created in %s" % snapdir)
+
+# probes can use the snapshot if all their system calls are first used after
+# the program is initialized
+def snapshot_applicable(syscalls, opts):
+    if not ENABLE_SNAPSHOT or STARTUP_SYSCALLS is None or len(opts):
+        return False
+    if len(set(syscalls) & STARTUP_SYSCALLS):
+        return False
+
+    with SNAPSHOT_LOCK:
+        if SNAPSHOT_DIR is None:
+            create_snapshot()
+    return ENABLE_SNAPSHOT
+
+def start_snapshot_restore(errno, syscalls, logf):
+    cleanup()
+
+    # criu and the restored tree inherit the seccomp filter
+    runcmd = [SECCOMPRUN_PATH, "-e", errno, "-n", str(len(syscalls))]
+    runcmd.extend(list(map(str, syscalls)))
+    runcmd.extend(["--", CRIU_BINARY, "restore", "--images-dir", SNAPSHOT_DIR,
+                   "--shell-job", "--tcp-established", "--log-file",
+                   os.path.basename(logf.name) + ".criu.log"])
+
+    ret = subprocess.Popen(runcmd, stderr=logf, stdout=logf,
+        preexec_fn=os.setsid)
+    wait_startup(ret, logf.name)
     return ret
 
+# the restored program keeps its original pid and process group
+def kill_snapshot():
+    try:
+        os.killpg(SNAPSHOT_PID, signal.SIGKILL)
+    except(ProcessLookupError, PermissionError):
+        pass
+
+# ======================
+# TIMING INSTRUMENTATION
+
+# one JSON record per probe is appended to TRACE_PATH (see --trace); the
+# per-phase totals are printed at the end with --time-report
+TRACE_PATH = None
+TRACE_LOCK = threading.Lock()
+ENABLE_TIME_REPORT = False
+
+CURRENT_PHASE = None
+PHASE_START = None
+PHASE_TIMES = {}
+
+def phase_stats(phase):
+    if phase not in PHASE_TIMES:
+        PHASE_TIMES[phase] = {"wall": 0.0, "probes": 0, "cached": 0,
+                "retries": 0, "startup": 0.0, "test": 0.0,
+                "teardown": 0.0, "retry": 0.0}
+    return PHASE_TIMES[phase]
+
+# close the current phase and start a new one; set_phase(None) closes the
+# last phase
+def set_phase(name):
+    global CURRENT_PHASE, PHASE_START
+    now = time.monotonic()
+    with TRACE_LOCK:
+        if CURRENT_PHASE is not None:
+            phase_stats(CURRENT_PHASE)["wall"] += now - PHASE_START
+        CURRENT_PHASE = name
+        PHASE_START = now
+
+def trace_probe(record):
+    if TRACE_PATH is None and not ENABLE_TIME_REPORT:
+        return
+    with TRACE_LOCK:
+        record["phase"] = CURRENT_PHASE
+        stats = phase_stats(CURRENT_PHASE)
+        stats["probes"] += 1
+        if record["outcome"] == "cached":
+            stats["cached"] += 1
+        if record["outcome"] == "retry":
+            stats["retries"] += 1
+        for k in ["startup", "test", "teardown", "retry"]:
+            stats[k] += record.get(k, 0)
+        if TRACE_PATH is not None:
+            with open(TRACE_PATH, "a") as f:
+                f.write(json.dumps(record) + "\n")
+
+def report_time():
+    if not ENABLE_TIME_REPORT:
+        return
+    total = sum([s["wall"] for s in PHASE_TIMES.values()])
+    info("Time report (wall clock; probe times add up across jobs):")
+    info("  %-14s %10s %7s %7s %7s %10s %10s %10s %10s" % ("phase", "wall",
+            "probes", "cached", "retries", "startup", "test", "teardown", "retry"))
+    for (phase, s) in PHASE_TIMES.items():
+        info("  %-14s %9.1fs %7d %7d %7d %9.1fs %9.1fs %9.1fs %9.1fs" % (phase,
+                s["wall"], s["probes"], s["cached"], s["retries"],
+                s["startup"], s["test"], s["teardown"], s["retry"]))
+    info("  %-14s %9.1fs" % ("total", total))
+
 # return (is used, success)
-def analyze_one_pass(errno, syscalls, log, errs, prefix=[], opts=[]):
+def analyze_one_pass(errno, syscalls, log, errs, prefix=[], opts=[], snapshot=False):
+    record = {"kind": "works", "errno": errno,
+              "syscalls": list(syscalls),
+              "opts": opts, "snapshot": snapshot, "attempt": errs}
+
+    # do not mistake the counts of a previous pass for this one's
+    if HIT_ACCOUNTING:
+        try:
+            os.remove(hits_path(log))
+        except OSError:
+            pass
+
+    used = cache_lookup(errno, syscalls, opts, snapshot)
+    if used is not None:
+        debug("Probe cache hit for %s" % describe_probe(errno, syscalls, opts))
+        record.update({"outcome": "cached", "works": used})
+        trace_probe(record)
+        return (used, True, errs)
+
+    cacheable = True
     with open(log, 'wb') as logf:
-        process = start_seccomp_run(errno, syscalls, logf)
+        t0 = time.monotonic()
+        if snapshot:
+            process = start_snapshot_restore(errno, syscalls, logf)
+        else:
+            process = start_seccomp_run(errno, syscalls, logf, prefix=prefix, opts=opts)
         process_ok = True
-        if ENABLE_SEQUENTIAL and (ZBINARY is None):
+        if ENABLE_SEQUENTIAL:
             process_ret = smart_wait(process, log)
             if process_ret:
                 process_ok = False
 
-        ret = start_test_cmd(log, log + ".test.log")
+        t1 = time.monotonic()
+        ret = start_test_cmd(log, log + ".test.log", process)
+        t2 = time.monotonic()
+        record.update({"startup": t1 - t0, "test": t2 - t1, "test_ret": ret})
 
         if (not ret and process_ok):
             # the program works without this syscall
@@ -219,17 +1213,114 @@ def analyze_one_pass(errno, syscalls, log, errs, prefix=[], opts=[]):
         elif (ret != 200):
             success = (False,True,errs)
         elif (ret == 200 and errs == LIMIT_RETRIES):
-            # see the comment below (in explore_perf) regarding retries
+            # see the comment below (in explore_perf) regarding retries;
+            # this is the outcome of a flaky run, do not cache it
             success = (False,True,errs)
+            cacheable = False
         else:
-            cleanup()
-            time.sleep(10)
+            crashed = not process_ok or probe_crashed(process)
+            if snapshot:
+                kill_snapshot()
+            cause = retry_after_failure(process, crashed, ret,
+                    describe_probe(errno, syscalls, opts), errs)
+            record.update({"retry": time.monotonic() - t2, "cause": cause})
             success = (False,False,errs + 1)
 
-        if not ENABLE_SEQUENTIAL:
-            os.killpg(os.getpgid(process.pid), signal.SIGKILL)
+        # concurrent probes do not have a cleanup() before the next probe,
+        # and supervised probes hold a slot of the supervisor until released
+        t3 = time.monotonic()
+        if not ENABLE_SEQUENTIAL or JOBS > 1 or ENABLE_CGROUPS or ENABLE_SUPERVISOR:
+            kill_probe(process)
+        if snapshot:
+            kill_snapshot()
+        record["teardown"] = time.monotonic() - t3
+        record.update(getattr(process, "cgroup_stats", {}))
+
+    hits = read_hits(log)
+    if hits is not None:
+        record["hits"] = hits
+    if success[1]:
+        record.update({"outcome": "works" if success[0] else "fails",
+                       "works": success[0]})
+    else:
+        record["outcome"] = "retry"
+    trace_probe(record)
+    log_hits(errno, syscalls, opts, record["outcome"], hits)
+
+    # a probe that worked without hitting its system calls may well fail
+    # next time, do not make it stick
+    if success[1] and cacheable and not (success[0] and probe_unhit(log)):
+        cache_store(errno, syscalls, opts, success[0], snapshot)
     return success
 
+# run analyze_one_pass() until we get a conclusive answer
+def probe_until_conclusive(errno, syscalls, opts, snapshot=False):
+    log = get_temp_file()
+
+    success = False
+    errs = 0
+
+    while (not success):
+        (used, success, errs) = analyze_one_pass(errno, syscalls, log, errs,
+                opts=opts, snapshot=snapshot)
+
+    if used and RERUN_UNHIT and probe_unhit(log):
+        debug("Probe %s did not hit its system calls, running it again" %
+                describe_probe(errno, syscalls, opts))
+        success = False
+        errs = 0
+        while (not success):
+            (used, success, errs) = analyze_one_pass(errno, syscalls, log, errs,
+                    opts=opts, snapshot=snapshot)
+
+    if used and probe_unhit(log):
+        record_unhit(errno, syscalls, opts)
+    return used
+
+# probe a set of system calls until we get a conclusive answer; return
+# whether the program works with them
+def probe_works(errno, syscalls, opts=[]):
+    used = journal_lookup("works", errno, syscalls, opts)
+    if used is not None:
+        return used
+
+    used = False
+    if snapshot_applicable(syscalls, opts):
+        used = probe_until_conclusive(errno, syscalls, opts, snapshot=True)
+        # if the restored program failed, the culprit may be criu itself
+        # using the system call; confirm with a regular probe
+    if not used:
+        used = probe_until_conclusive(errno, syscalls, opts)
+
+    journal_record("works", errno, syscalls, opts, used)
+    return used
+
+# run probe(item) for all items on up to JOBS workers; results are returned
+# in the order of items
+def run_probes(probe, items, show_progress=True):
+    items = list(items)
+    if JOBS <= 1:
+        results = []
+        for (n, item) in enumerate(items):
+            if show_progress:
+                progress(n + 1, len(items))
+            results.append(probe(item))
+        return results
+
+    # probes mostly wait on subprocesses, threads are enough
+    with concurrent.futures.ThreadPoolExecutor(max_workers=JOBS) as pool:
+        futures = [pool.submit(probe, item) for item in items]
+        done = 0
+        for f in concurrent.futures.as_completed(futures):
+            if f.exception() is not None:
+                # do not run the queued probes for nothing
+                pool.shutdown(cancel_futures=True)
+                f.result()
+            done += 1
+            if show_progress:
+                progress(done, len(items))
+        return [f.result() for f in futures]
+
 # ===========
 # EXPLORATION
 
@@ -239,33 +1330,17 @@ FEATURE_TRANSLATIONS = {}
 # executed by the application. It uses strace underneath, but the
 # version has to be very recent, potentially compiled from source.
 def initial_strace_scan():
-    def generate_regex_feature(syscall, position, comment=False):
-        farg = "(?:{[^}]*}|[^{][^,]*)"
-        regex = syscall + "\("
-        if position > 0:
-            for i in range(position):
-                regex += "%s, " % farg
-        if not comment:
-            regex += "([a-zA-Z0-9_]+)"
-        else:
-            regex += "([a-zA-Z0-9_]+) /\* ([^\*]+) \*/"
-        return regex
+    cleanup(force=True)
 
-    def generate_regex_files(syscall, position):
-        farg = "[^,]+"
-        regex = syscall + "\("
-        if position > 0:
-            for i in range(position):
-                regex += "%s, " % farg
-        regex += "\"([^\"]+)\""
-        return regex
-
-    cleanup()
-
-    # --status=successful,failed greatly simplifies the output of strace for us to parse
-    # and should not impact the number of system calls that we see or their arguments, only
-    # their relative ordering, which doesn't matter to us.
-    runcmd = [STRACE_BINARY, "-tfnX", "verbose",  "--status=successful,failed", str(binary_path)]
+    if BUILTIN_TRACER:
+        runcmd = discovery_cmd()
+        scanlog = INITIAL_SCAN_DISCOVERY
+    else:
+        # --status=successful,failed greatly simplifies the output of strace for us to parse
+        # and should not impact the number of system calls that we see or their arguments, only
+        # their relative ordering, which doesn't matter to us.
+        runcmd = [STRACE_BINARY, "-tfnX", "verbose",  "--status=successful,failed", str(binary_path)]
+        scanlog = INITIAL_SCAN_STDERR
     runcmd.extend(binary_options)
 
     process = None
@@ -273,13 +1348,17 @@ def initial_strace_scan():
     tries = 0
 
     while (not success):
+        remove_stale_pidfile()
+        open(scanlog, "w").close()
         with open(INITIAL_SCAN_STDERR, "w") as stderr:
             with open(INITIAL_SCAN_STDOUT, "w") as stdout:
                 process = subprocess.Popen(runcmd, stderr=stderr,
                                             stdout=stdout,
                                             preexec_fn=os.setsid)
 
-        time.sleep(WAIT_STARTUP_TIME)
+        wait_startup(process, INITIAL_SCAN_STDOUT)
+        # what strace logged until now is the initialization of the program
+        ready_offset = os.path.getsize(scanlog)
 
         traced_program_ok = True
         traced_program_ret = -1
@@ -291,10 +1370,13 @@ def initial_strace_scan():
             if traced_program_ret:
                 traced_program_ok = False
 
-        ret = start_test_cmd(INITIAL_SCAN_STDOUT, INITIAL_SCAN_STDOUT + ".test.log")
+        ret = start_test_cmd(INITIAL_SCAN_STDOUT, INITIAL_SCAN_STDOUT + ".test.log",
+                             process)
+        crashed = not traced_program_ok or probe_crashed(process)
 
         if not ENABLE_SEQUENTIAL:
-            os.killpg(os.getpgid(process.pid), signal.SIGKILL)
+            # probe_crashed() may have reaped strace already
+            kill_probe(process)
 
         if ret == 0 and traced_program_ok:
             success = True
@@ -308,115 +1390,310 @@ def initial_strace_scan():
             else:
                 debug("Initial strace scan attempt failed, test returned %d," \
                     "test output in %s" % (ret, INITIAL_SCAN_STDOUT + ".test.log"))
-            cleanup()
-            time.sleep(10)
+            retry_after_failure(process, crashed, ret, "initial strace scan", tries)
             tries += 1
 
-    rets = []
-    features = {}
-    files = {}
-    with open(INITIAL_SCAN_STDERR) as logf:
-        full = logf.read()
-        regex = re.compile("\[\s+(\d+)\]")
-        rets = list(set(regex.findall(full)))
-
-        # parse used features
-        for syscall in SYSCALL_FLAGS.keys():
-            regex = re.compile(generate_regex_feature(syscall,
-                               SYSCALL_FLAGS[syscall]))
-            features[syscall] = list(set(regex.findall(full)))
-            features[syscall] = list(map(lambda i: int(i[2:], 16)
-                    if i[:2] == "0x" else int(i), features[syscall]))
-
-            FEATURE_TRANSLATIONS[syscall] = {}
-            regex = re.compile(generate_regex_feature(syscall,
-                               SYSCALL_FLAGS[syscall], comment=True))
-            matches = regex.findall(full)
-            for m in matches:
-                if len(m) == 2:
-                    if m[0][:2] == "0x":
-                        FEATURE_TRANSLATIONS[syscall][int(m[0][2:], 16)] = m[1]
-                    else:
-                        FEATURE_TRANSLATIONS[syscall][int(m[0])] = m[1]
-
-        # parse used files
-        for syscall in SYSCALL_FLAGS_FILES.keys():
-            regex = re.compile(generate_regex_files(syscall,
-                               SYSCALL_FLAGS_FILES[syscall]))
-            files[syscall] = list(set(regex.findall(full)))
+    if BUILTIN_TRACER:
+        return parse_discovery_log(scanlog, ready_offset)
+    return parse_strace_log(scanlog, ready_offset)
+
+# record the system calls with seccomp-run instead of strace, along with the
+# arguments that parse_strace_log() extracts
+def discovery_cmd():
+    runcmd = [SECCOMPRUN_PATH, "-q", "-D", INITIAL_SCAN_DISCOVERY]
+    for (syscall, pos) in SYSCALL_FLAGS.items():
+        runcmd.extend(["-a", "%d:%d" % (syscall_name_to_int(syscall), pos)])
+    for (syscall, pos) in SYSCALL_FLAGS_FILES.items():
+        runcmd.extend(["-s", "%d:%d" % (syscall_name_to_int(syscall), pos)])
+    if ZBINARY is not None:
+        runcmd.extend(["-y", ''.join(ZBINARY)])
+    runcmd.extend(["--", str(binary_path)])
+    return runcmd
+
+# same as parse_strace_log(), for the log of seccomp-run -D (one JSON object
+# per line and per new system call, argument value or path); there are no
+# symbolic values, so no FEATURE_TRANSLATIONS
+def parse_discovery_log(path, ready_offset=None):
+    global STARTUP_SYSCALLS
+
+    names = dict([(syscall_name_to_int(syscall), syscall) for syscall in
+                  list(SYSCALL_FLAGS.keys()) + list(SYSCALL_FLAGS_FILES.keys())])
+    rets = set()
+    startup = set()
+    features = dict([(syscall, set()) for syscall in SYSCALL_FLAGS.keys()])
+    files = dict([(syscall, set()) for syscall in SYSCALL_FLAGS_FILES.keys()])
+    for syscall in SYSCALL_FLAGS.keys():
+        FEATURE_TRANSLATIONS[syscall] = {}
+
+    pos = 0
+    with open(path, "rb") as logf:
+        for raw in logf:
+            pos += len(raw)
+            try:
+                record = json.loads(raw.decode("utf-8", errors="replace"))
+            except ValueError:
+                # killed while writing the last line
+                continue
+
+            if "arg" not in record:
+                rets.add(record["nr"])
+                if ready_offset is not None and pos <= ready_offset:
+                    startup.add(record["nr"])
+            elif "path" in record:
+                files[names[record["nr"]]].add(record["path"])
+            else:
+                features[names[record["nr"]]].add(record["val"])
+
+    if ready_offset is not None:
+        STARTUP_SYSCALLS = startup
+
+    return ([e for e in rets if e <= MAX_SYSCALL],
+            {k:list(v) for (k,v) in features.items() if len(v) > 0},
+            {k:list(v) for (k,v) in files.items() if len(v) > 0})
+
+# extract the used system calls, flag features (and their translations) and
+# files from a strace log; this goes through the log line by line, in a single
+# pass, so that memory usage does not depend on the size of the log. System
+# calls logged before ready_offset are recorded in STARTUP_SYSCALLS.
+def parse_strace_log(path, ready_offset=None):
+    global STARTUP_SYSCALLS
+
+    def generate_regex_feature(syscall, position, comment=False):
+        farg = "(?:{[^}]*}|[^{][^,]*)"
+        regex = syscall + "\("
+        if position > 0:
+            for i in range(position):
+                regex += "%s, " % farg
+        if not comment:
+            regex += "([a-zA-Z0-9_]+)"
+        else:
+            regex += "([a-zA-Z0-9_]+) /\* ([^\*]+) \*/"
+        return regex
+
+    def generate_regex_files(syscall, position):
+        farg = "[^,]+"
+        regex = syscall + "\("
+        if position > 0:
+            for i in range(position):
+                regex += "%s, " % farg
+        regex += "\"([^\"]+)\""
+        return regex
+
+    def parse_int(v):
+        return int(v[2:], 16) if v[:2] == "0x" else int(v)
+
+    # strace may print some values symbolically, only numbers can be probed
+    def is_int(v):
+        return re.fullmatch("0x[0-9a-fA-F]+|[0-9]+", v) is not None
+
+    ret_regex = re.compile("\[\s+(\d+)\]")
+    feature_regexes = dict([(syscall + "(", (syscall,
+            re.compile(generate_regex_feature(syscall, pos)),
+            re.compile(generate_regex_feature(syscall, pos, comment=True))))
+            for (syscall, pos) in SYSCALL_FLAGS.items()])
+    file_regexes = dict([(syscall + "(", (syscall,
+            re.compile(generate_regex_files(syscall, pos))))
+            for (syscall, pos) in SYSCALL_FLAGS_FILES.items()])
+
+    rets = set()
+    startup = set()
+    features = dict([(syscall, set()) for syscall in SYSCALL_FLAGS.keys()])
+    files = dict([(syscall, set()) for syscall in SYSCALL_FLAGS_FILES.keys()])
+    for syscall in SYSCALL_FLAGS.keys():
+        FEATURE_TRANSLATIONS[syscall] = {}
+
+    pos = 0
+    with open(path, "rb") as logf:
+        for raw in logf:
+            pos += len(raw)
+            line = raw.decode("utf-8", errors="replace")
+
+            numbers = ret_regex.findall(line)
+            rets.update(numbers)
+            if ready_offset is not None and pos <= ready_offset:
+                startup.update(numbers)
+
+            # cheap substring checks first, most lines match none of these
+            for (prefix, (syscall, regex, regex_comment)) in feature_regexes.items():
+                if prefix not in line:
+                    continue
+                for v in regex.findall(line):
+                    if is_int(v):
+                        features[syscall].add(parse_int(v))
+                for (v, translation) in regex_comment.findall(line):
+                    if is_int(v):
+                        FEATURE_TRANSLATIONS[syscall][parse_int(v)] = translation
+
+            for (prefix, (syscall, regex)) in file_regexes.items():
+                if prefix in line:
+                    files[syscall].update(regex.findall(line))
+
+    if ready_offset is not None:
+        STARTUP_SYSCALLS = set([int(e) for e in startup])
 
     return ([int(e) for e in rets if int(e) <= MAX_SYSCALL],
-            {k:v for (k,v) in features.items() if len(v) > 0},
-            {k:v for (k,v) in files.items() if len(v) > 0})
+            {k:list(v) for (k,v) in features.items() if len(v) > 0},
+            {k:list(v) for (k,v) in files.items() if len(v) > 0})
 
 # given an errno and a list of system calls, return the list of system
 # calls that worked
 def explore_works(errno, syscalls):
-    unused = set()
-    for i in syscalls:
-        progress(i, max(syscalls))
-        log = get_temp_file()
-
-        s = False
-        errs = 0
+    return explore_works_combined([errno], syscalls)[errno]
+
+# same as explore_works(), for several errnos at once: the probes of all
+# errnos are interleaved on the same workers, so that with --jobs the
+# workers do not idle at the end of a pass; return {errno: system calls}
+def explore_works_combined(errnos, syscalls):
+    syscalls = list(syscalls)
+    if GROUP_TESTING:
+        return explore_works_grouped(errnos, syscalls)
+    items = [(errno, i) for i in syscalls for errno in errnos]
+    works = run_probes(lambda item: probe_works(item[0], [item[1]]), items)
+    progress_end()
+    ret = dict([(errno, set()) for errno in errnos])
+    for ((errno, i), w) in zip(items, works):
+        if w:
+            ret[errno].add(i)
+    return ret
 
-        while (not s):
-            (u, s, errs) = analyze_one_pass(errno, [i], log, errs)
-            if (u):
-                # the program works without feature j in syscall i
-                unused.add(i)
+# same as explore_works_combined(), but probe whole batches of system calls at
+# once and only bisect the batches that fail: if k system calls are required,
+# this takes O(k log n) probes instead of n. This assumes that if a set of
+# system calls works stubbed together, each of them also works stubbed on
+# its own; with faking (errno 0), we check.
+def explore_works_grouped(errnos, syscalls):
+    unused = dict([(errno, set()) for errno in errnos])
+    if not len(syscalls):
+        return unused
+
+    batches = [(errno, syscalls) for errno in errnos]
+    total = len(syscalls) * len(errnos)
+    resolved = 0
+    probes = 0
+    while len(batches):
+        works = run_probes(lambda eb: probe_works(eb[0], eb[1]), batches,
+                           show_progress=False)
+        probes += len(batches)
+
+        pending = []
+        for ((errno, b), w) in zip(batches, works):
+            if (w) and len(b) > 1 and errno == "0":
+                # faking is not monotone: faking a system call may skip the
+                # code that uses another, confirm each of them on its own
+                pending.extend([(errno, [e]) for e in b])
+            elif (w):
+                # the program works without any of the system calls in b
+                unused[errno].update(b)
+                resolved += len(b)
+            elif len(b) == 1:
+                resolved += 1
+            else:
+                pending.append((errno, b[:len(b) // 2]))
+                pending.append((errno, b[len(b) // 2:]))
+        batches = pending
+        progress(resolved, total)
     progress_end()
+
+    debug("Group testing took %d probes for %d system calls" % (probes, total))
     return unused
 
+# return a 1-minimal subset of syscalls that does not work with errno, i.e.,
+# removing any system call from it makes it work (delta debugging, ddmin);
+# syscalls must not work as a whole
+def find_culprit(errno, syscalls):
+    fails = lambda c: not probe_works(errno, c)
+
+    c = list(syscalls)
+    n = 2
+    while len(c) >= 2:
+        size = len(c) / n
+        chunks = [c[int(i * size):int((i + 1) * size)] for i in range(n)]
+        complements = [[e for e in c if e not in chunk] for chunk in chunks]
+        subsets = chunks + (complements if n > 2 else [])
+        if JOBS > 1:
+            # probe all subsets of a round concurrently
+            failed = run_probes(fails, subsets, show_progress=False)
+            i = failed.index(True) if True in failed else None
+        else:
+            i = next((i for (i, sub) in enumerate(subsets) if fails(sub)), None)
+
+        if i is not None and i < n:
+            # one of the chunks fails on its own, continue with it
+            c = chunks[i]
+            n = 2
+        elif i is not None:
+            # the culprit is spread, remove one chunk
+            c = complements[i - n]
+            n = max(n - 1, 2)
+        elif n < len(c):
+            n = min(len(c), 2 * n)
+        else:
+            break
+    return c
+
+# return disjoint minimal subsets of syscalls that do not work with errno,
+# until the remaining system calls work together
+def find_culprits(errno, syscalls):
+    culprits = []
+    remaining = list(syscalls)
+    while len(remaining) and not probe_works(errno, remaining):
+        culprit = find_culprit(errno, remaining)
+        if len(culprit) <= 1:
+            # each system call worked on its own, the program is flaky
+            break
+        culprits.append(culprit)
+        remaining = [e for e in remaining if e not in culprit]
+    return culprits
+
+# check that the entire set works with errno; if it doesn't, find and log the
+# minimal subsets that do not work together
+def final_check(errno, syscalls, action, participle):
+    log = get_temp_file()
+    (u, s, r) = analyze_one_pass(errno, syscalls, log, 0)
+    if u:
+        info("Final check analysis for %s succeeded; the entire set can be %s simultaneously." %
+                (action, participle))
+        return
+
+    warning("Final check analysis for %s failed; the entire set cannot be %s simultaneously." %
+            (action, participle))
+    info("Looking for the culprit(s)...")
+    culprits = find_culprits(errno, syscalls)
+    for c in culprits:
+        warning("Jointly unsafe set for %s: %s" % (action,
+                ",".join(map(str, format_syscall_list(c)))))
+    if not len(culprits):
+        warning("We recommend a manual pass with seccomp_run to find the culprit.")
+
 def syscall_name_to_int(syscall):
     for (s,n) in syscall_mapping.items():
         if (s == syscall):
             return n
 
 def explore_works_partial(errno, features):
-    retval = dict()
-    numfeatures = len([i for subl in features.values() for i in subl])
-    t = 1
-    for i in features.keys():
-        retval[i] = set()
-        for j in features[i]:
-            progress(t, numfeatures)
-            log = get_temp_file()
-
-            success = False
-            errs = 0
-
-            while (not success):
-                (used, success, errs) = analyze_one_pass(errno, [syscall_name_to_int(i)], log, errs,
-                        opts=["-p", str(SYSCALL_FLAGS[i]), str(j)])
-                if (used):
-                    # the program works without feature j in syscall i
-                    retval[i].add(j)
-            t += 1
+    probes = [(i, j) for i in features.keys() for j in features[i]]
+    works = run_probes(lambda p: probe_works(errno, [syscall_name_to_int(p[0])],
+                opts=["-p", str(SYSCALL_FLAGS[p[0]]), str(p[1])]), probes)
     progress_end()
+
+    retval = dict([(i, set()) for i in features.keys()])
+    for ((i, j), w) in zip(probes, works):
+        if (w):
+            # the program works without feature j in syscall i
+            retval[i].add(j)
     return retval
 
 def explore_works_specialfiles(errno, files):
-    retval = dict()
-    numfeatures = len([i for subl in files.values() for i in subl])
-    t = 1
-    for i in files.keys():
-        retval[i] = set()
-        for j in files[i]:
-            progress(t, numfeatures)
-            log = get_temp_file()
-
-            success = False
-            errs = 0
-
-            while (not success):
-                (used, success, errs) = analyze_one_pass(errno, [syscall_name_to_int(i)], log, errs,
-                        opts=["-t", str(SYSCALL_FLAGS_FILES[i]), j])
-                if (used):
-                    # the program works without feature j in syscall i
-                    retval[i].add(j)
-            t += 1
+    probes = [(i, j) for i in files.keys() for j in files[i]]
+    works = run_probes(lambda p: probe_works(errno, [syscall_name_to_int(p[0])],
+                opts=["-t", str(SYSCALL_FLAGS_FILES[p[0]]), p[1]]), probes)
     progress_end()
+
+    retval = dict([(i, set()) for i in files.keys()])
+    for ((i, j), w) in zip(probes, works):
+        if (w):
+            # the program works without file j in syscall i
+            retval[i].add(j)
     return retval
 
 def open_fds(pid):
@@ -439,73 +1716,403 @@ def peak_memsize(pid):
         return -1
     return int(size[:-3])
 
-# given an errno and a list of system calls, return a mapping of system calls
-# and resulting performance
-def explore_perf(errno, syscalls):
-    perf = dict()
-    for i in syscalls:
+# ==============
+# STATIC PRUNING
 
-        if len(syscalls) > 1:
-            # no progress bar when doing baseline
-            progress(i, max(syscalls))
+STATIC_ANALYSER_OUTPUT = None
 
-        # (average performance, average no. of open FDs, average peak memory usage in KB)
-        perf[i] = {"perf": 0, "openfds": 0, "memusage": 0}
-        errs = 0
+def static_analyser_cmd(path):
+    return [str(os.path.join(os.path.realpath(os.path.dirname(__file__)),
+            "src/static-binary-analyser/static_analyser.py")), "-a", str(path),
+            "--csv=true", "--display=false", "--verbose=false"]
 
-        for j in range(NO_RUNS_AVG):
-            log = get_temp_file()
-
-            success = False
-            while (not success):
-                with open(log, 'wb') as logf:
-                    process = start_seccomp_run(errno, [i], logf,
-                        prefix=["taskset", "-c", str(TASKSET_CPU)])
-
-                    testcmd = [testscript_path, log, "benchmark"]
-
-                    try:
-                        out = subprocess.check_output(testcmd).decode(sys.stdout.encoding)
-                        perf[i]["perf"] += float(out)
-                        perf[i]["openfds"] += float(open_fds(process.pid))
-                        perf[i]["memusage"] += float(peak_memsize(process.pid))
-                        os.killpg(os.getpgid(process.pid), signal.SIGKILL)
-                        success = True
-                    except(subprocess.CalledProcessError):
-                        # in theory, this shouldn't happen
-                        # in practice, it happens because ports don't get freed in
-                        # time between the starting and stopping of nginx
-                        # in this case we just want to wait a bit and retry
-                        # if it happens to many time in a row, just abort, it's bad.
-                        os.killpg(os.getpgid(process.pid), signal.SIGKILL)
-                        errs += 1
-                        if (errs >= LIMIT_RETRIES):
-                            print()
-                            error("Error: syscall " + str(i) + " does not actually seem " +
-                                  "to work with errno " + str(errno) + " OR test script " +
-                                  "doesn't support performance benchmark mode.")
-                            error("Cause: CalledProcessError")
-                            exit(1)
-                        else:
-                            cleanup()
-                            time.sleep(10)
-                    except(ValueError):
-                        print()
-                        error("Error: syscall " + str(i) + " does not actually seem " +
-                              "to work with errno " + str(errno) + " OR test script " +
-                              "doesn't support performance benchmark mode.")
-                        error("Cause: ValueError")
-                        os.killpg(os.getpgid(process.pid), signal.SIGKILL)
-                        exit(1)
-        perf[i]["perf"] /= NO_RUNS_AVG
-        perf[i]["openfds"] /= NO_RUNS_AVG
-        perf[i]["memusage"] /= NO_RUNS_AVG
-
-    if len(syscalls) > 1:
-        progress_end()
+# return the set of system calls that the static analyser finds in the
+# target binary, None if it failed; its output is kept for the static
+# analysis at the end (see ENABLE_STATIC)
+def static_syscalls():
+    global STATIC_ANALYSER_OUTPUT
+    path = binary_path if ZBINARY is None else ZBINARY
+    try:
+        output = subprocess.check_output(static_analyser_cmd(path)).decode('utf-8')
+    except (OSError, subprocess.CalledProcessError) as e:
+        warning("Static analysis of %s failed: %s" % (path, e))
+        return None
+    STATIC_ANALYSER_OUTPUT = output
+
+    found = set()
+    for line in output.splitlines():
+        if line.startswith("#") or not len(line.strip()):
+            continue
+        (nr, used) = line.split(",")
+        if used.strip() == "Y":
+            found.add(int(nr))
+    return found
+
+# return the system calls among syscalls that the crash scan has to probe:
+# those that the static analyser finds, unless it missed one of a random
+# sample of the others (or failed), in which case we probe them all
+def static_prune(syscalls):
+    syscalls = list(syscalls)
+    found = static_syscalls()
+    if found is None:
+        warning("Not pruning the crash scan.")
+        return syscalls
+
+    candidates = [s for s in syscalls if s in found]
+    pruned = [s for s in syscalls if s not in found]
+    sample = random.sample(pruned, min(STATIC_PRUNE_SAMPLE, len(pruned)))
+    info("Static analysis found %d system calls, checking that %d of the %d " \
+         "others are unused..." % (len(candidates), len(sample), len(pruned)))
+
+    missed = set(sample) - explore_works("crash", sample)
+    if len(missed):
+        warning("Static analysis missed system call(s) %s, not pruning the crash scan." %
+                ",".join(map(str, format_syscall_list(sorted(missed)))))
+        return syscalls
+    return candidates
+
+# =================
+# RESOURCE SAMPLING
+
+# with --perf-counters, count these events of the benchmarked program while
+# the benchmark runs, as (name, perf_event_attr type, config)
+PERF_COUNTERS = False
+PERF_EVENTS = [("instructions", 0, 1), ("cycles", 0, 0), ("page_faults", 1, 2)]
+# x86_64, as seccomp-run
+SYS_PERF_EVENT_OPEN = 298
+PERF_FLAG_PID_CGROUP = 1 << 2
+LIBC = None
+
+# pids of the processes of a probe: those of its cgroup if it has one,
+# otherwise those of its session (seccomp-run is started with setsid)
+def process_tree(process):
+    if getattr(process, "cgroup", None) is not None:
+        with open(os.path.join(process.cgroup, "cgroup.procs")) as procs:
+            return [int(pid) for pid in procs.read().split()]
+
+    pids = []
+    for pid in os.listdir("/proc"):
+        if not pid.isdigit():
+            continue
+        try:
+            with open("/proc/%s/stat" % pid) as statf:
+                # the command name may contain spaces, skip past it
+                fields = statf.read().rpartition(")")[2].split()
+        except(OSError):
+            continue
+        if int(fields[3]) == process.pid and fields[0] != "Z":
+            pids.append(int(pid))
+    return pids
+
+# resources used by the whole process tree of a probe, unlike open_fds() and
+# peak_memsize() which only look at the top-level process: open FDs, peak
+# memory usage in KB (sum of the peak RSS, or the peak of the cgroup), CPU
+# time in seconds and context switches
+def tree_resources(process):
+    res = {"tree_openfds": 0, "tree_memusage": 0, "cpu_time": 0.0,
+           "ctx_switches": 0}
+    for pid in process_tree(process):
+        try:
+            fds = len(os.listdir("/proc/%d/fd" % pid))
+            with open("/proc/%d/status" % pid) as statusf:
+                status = dict([line.split(":", 1) for line in statusf])
+            with open("/proc/%d/stat" % pid) as statf:
+                fields = statf.read().rpartition(")")[2].split()
+        except(OSError):
+            # exited in the meantime
+            continue
+        res["tree_openfds"] += fds
+        res["tree_memusage"] += int(status.get("VmHWM", "0 kB").split()[0])
+        res["ctx_switches"] += int(status["voluntary_ctxt_switches"]) + \
+                               int(status["nonvoluntary_ctxt_switches"])
+        res["cpu_time"] += (int(fields[11]) + int(fields[12])) / \
+                           os.sysconf("SC_CLK_TCK")
+
+    if getattr(process, "cgroup", None) is not None:
+        # more accurate, and includes the processes that already exited
+        stats = cgroup_stats(process.cgroup)
+        res["tree_memusage"] = stats.get("memory_peak", res["tree_memusage"])
+        res["cpu_time"] = stats.get("cpu_usage", res["cpu_time"])
+    return res
+
+# start counting PERF_EVENTS for the cgroup of a probe on a CPU (the program
+# is pinned to it); events that the machine does not support are skipped
+def perf_counters_open(process, cpu):
+    global LIBC
+    if not PERF_COUNTERS:
+        return []
+    if LIBC is None:
+        LIBC = ctypes.CDLL(None, use_errno=True)
+
+    counters = []
+    cgroupfd = os.open(process.cgroup, os.O_RDONLY)
+    for (name, type, config) in PERF_EVENTS:
+        # struct perf_event_attr, PERF_ATTR_SIZE_VER0
+        attr = struct.pack("IIQQQQQIIQ", type, 64, config, 0, 0, 0, 0, 0, 0, 0)
+        fd = LIBC.syscall(SYS_PERF_EVENT_OPEN, attr, cgroupfd, cpu, -1,
+                          PERF_FLAG_PID_CGROUP)
+        if fd < 0:
+            debug("Cannot count %s: %s" % (name, os.strerror(ctypes.get_errno())))
+            continue
+        counters.append((name, fd))
+    os.close(cgroupfd)
+    return counters
+
+def perf_counters_read(counters):
+    values = {}
+    for (name, fd) in counters:
+        values[name] = struct.unpack("Q", os.read(fd, 8))[0]
+        os.close(fd)
+    return values
+
+# ==================
+# BENCHMARK CPU POOL
+
+# CPUs to run benchmarks on (see --perf-cpus); with --jobs, independent
+# benchmarks run concurrently, each on its own CPU, and each CPU has its own
+# baseline to cancel out core-to-core variance
+PERF_CPUS = None
+# also bind the memory of benchmarks to the NUMA node of their CPU
+PERF_NUMA = False
+PERF_CPU_POOL = None
+
+# parse a CPU list as in /sys (e.g., "2-4,7")
+def parse_cpu_list(spec):
+    cpus = []
+    for r in spec.strip().split(","):
+        if not len(r):
+            continue
+        (first, _, last) = r.partition("-")
+        cpus.extend(range(int(first), int(last or first) + 1))
+    return cpus
+
+# TASKSET_CPU, unless our cpuset does not allow it
+def default_perf_cpus():
+    allowed = os.sched_getaffinity(0)
+    if TASKSET_CPU in allowed:
+        return [TASKSET_CPU]
+    warning("CPU %d is not available, benchmarking on CPU %d " % (TASKSET_CPU, max(allowed)) +
+            "(see --perf-cpus).")
+    return [max(allowed)]
+
+# CPUs isolated from the scheduler (isolcpus=) that our cpuset allows (see
+# --perf-cpus auto), or the default if there are none
+def discover_perf_cpus():
+    try:
+        with open("/sys/devices/system/cpu/isolated") as f:
+            cpus = sorted(set(parse_cpu_list(f.read())) & os.sched_getaffinity(0))
+    except(OSError, ValueError):
+        cpus = []
+    if len(cpus):
+        return cpus
+    warning("No isolated CPU found for --perf-cpus auto.")
+    return default_perf_cpus()
+
+def cpu_node(cpu):
+    for e in os.listdir("/sys/devices/system/cpu/cpu%d" % cpu):
+        if re.fullmatch("node[0-9]+", e):
+            return int(e[4:])
+    return 0
+
+def perf_prefix(cpu):
+    if PERF_NUMA:
+        return ["numactl", "--physcpubind=%d" % cpu, "--membind=%d" % cpu_node(cpu)]
+    return ["taskset", "-c", str(cpu)]
+
+# run f(item, cpu) for all items, each on a CPU of the pool that is not in
+# use; results are returned in the order of items
+def run_on_cpus(f, items, show_progress=True):
+    def run(item):
+        cpu = PERF_CPU_POOL.get()
+        try:
+            return f(item, cpu)
+        finally:
+            PERF_CPU_POOL.put(cpu)
+    return run_probes(run, items, show_progress)
+
+class BenchmarkFailed(Exception):
+    pass
+
+# raised rather than exit(), which would only end the worker thread with
+# --jobs (see run_probes() and perf_pass())
+def perf_failed(errno, i, cause):
+    print()
+    error("Error: syscall " + str(i) + " does not actually seem " +
+          "to work with errno " + str(errno) + " OR test script " +
+          "doesn't support performance benchmark mode.")
+    error("Cause: " + cause)
+    raise BenchmarkFailed(cause)
+
+# run f(*args), a pass of benchmarks, and exit if one of them failed
+def perf_pass(f, *args):
+    try:
+        return f(*args)
+    except(BenchmarkFailed):
+        exit(1)
+
+# run the benchmark once for system call i and errno; return the sample
+# (performance, no. of open FDs, peak memory usage in KB) and the updated
+# number of failed runs for this system call
+def perf_sample(errno, i, errs, cpu):
+    log = get_temp_file()
+
+    while True:
+        with open(log, 'wb') as logf:
+            record = {"kind": "perf", "errno": errno, "syscalls": [i],
+                      "attempt": errs, "cpu": cpu}
+            t0 = time.monotonic()
+            process = start_seccomp_run(errno, [i], logf, prefix=perf_prefix(cpu))
+
+            testcmd = netns_test_cmd([testscript_path, log, "benchmark"],
+                                     process)
+
+            counters = perf_counters_open(process, cpu)
+            try:
+                t1 = time.monotonic()
+                out = subprocess.check_output(testcmd).decode(sys.stdout.encoding)
+                t2 = time.monotonic()
+                sample = {"perf": float(out),
+                          "openfds": float(open_fds(process.pid)),
+                          "memusage": float(peak_memsize(process.pid))}
+                sample.update(perf_counters_read(counters))
+                sample.update(tree_resources(process))
+                kill_probe(process)
+                record.update(sample)
+                record.update({"startup": t1 - t0, "test": t2 - t1,
+                               "teardown": time.monotonic() - t2,
+                               "outcome": "works"})
+                trace_probe(record)
+                return (sample, errs)
+            except(subprocess.CalledProcessError) as e:
+                # in theory, this shouldn't happen
+                # in practice, it happens because ports don't get freed in
+                # time between the starting and stopping of nginx
+                # in this case we just want to wait a bit and retry
+                # if it happens to many time in a row, just abort, it's bad.
+                t2 = time.monotonic()
+                perf_counters_read(counters)
+                crashed = probe_crashed(process)
+                kill_probe(process)
+                record.update({"startup": t1 - t0, "test": t2 - t1,
+                               "teardown": time.monotonic() - t2,
+                               "test_ret": e.returncode})
+                errs += 1
+                if (errs >= LIMIT_RETRIES):
+                    perf_failed(errno, i, "CalledProcessError")
+                t3 = time.monotonic()
+                cause = retry_after_failure(process, crashed, e.returncode,
+                        "perf, " + describe_probe(errno, [i]), errs - 1)
+                record.update({"retry": time.monotonic() - t3,
+                               "cause": cause, "outcome": "retry"})
+                trace_probe(record)
+            except(ValueError):
+                perf_counters_read(counters)
+                kill_probe(process)
+                perf_failed(errno, i, "ValueError")
+
+# two-sided 95% quantiles of Student's t distribution, for 1 to 30 degrees
+# of freedom; beyond that, the normal approximation is good enough
+T_TABLE_95 = [12.706, 4.303, 3.182, 2.776, 2.571, 2.447, 2.365, 2.306, 2.262,
+              2.228, 2.201, 2.179, 2.160, 2.145, 2.131, 2.120, 2.110, 2.101,
+              2.093, 2.086, 2.080, 2.074, 2.069, 2.064, 2.060, 2.056, 2.052,
+              2.048, 2.045, 2.042]
+
+# return (mean, standard deviation, half-width of the 95% confidence
+# interval of the mean) of a list of values
+def perf_stats(values):
+    mean = statistics.mean(values)
+    if len(values) < 2:
+        return (mean, 0.0, float("inf"))
+    stddev = statistics.stdev(values)
+    df = len(values) - 1
+    t = T_TABLE_95[df - 1] if df <= len(T_TABLE_95) else 1.96
+    return (mean, stddev, t * stddev / math.sqrt(len(values)))
+
+# whether we have enough samples: NO_RUNS_AVG of them, or with --perf-ci,
+# a narrow enough confidence interval (within PERF_MAX_RUNS runs)
+def perf_converged(samples):
+    n = len(samples)
+    if PERF_CI is None:
+        return n >= NO_RUNS_AVG
+    if n >= PERF_MAX_RUNS:
+        return True
+    if n < PERF_MIN_RUNS:
+        return False
+    (mean, stddev, ci) = perf_stats([e["perf"] for e in samples])
+    return ci <= PERF_CI * abs(mean)
+
+# average a list of samples, along with the statistics of the performance
+def perf_summary(samples):
+    (mean, stddev, ci) = perf_stats([e["perf"] for e in samples])
+    summary = {"perf": mean, "stddev": stddev, "ci": ci, "runs": len(samples)}
+    # openfds, memusage, and the resources of the process tree
+    for k in samples[0].keys():
+        if k != "perf" and all([k in e for e in samples]):
+            summary[k] = statistics.mean([e[k] for e in samples])
+    return summary
+
+# sample the performance of system call i with errno on a CPU until
+# perf_converged()
+def perf_measure(errno, i, cpu, samples=[]):
+    samples = list(samples)
+    errs = 0
+    while not perf_converged(samples):
+        (sample, errs) = perf_sample(errno, i, errs, cpu)
+        samples.append(sample)
+    perf = perf_summary(samples)
+    perf["cpu"] = cpu
+    return perf
 
+# the first runs of the program are usually slower (cold caches, CPU
+# frequency scaling, etc.); run the baseline on a CPU until the last
+# NO_RUNS_AVG runs are stable, and keep these as samples for the baseline
+def perf_baseline(cpu):
+    key = ["cpu%d" % cpu]
+    perf = journal_lookup("baseline", str(ERRNO_ENOSYS), [BASELINE_SYSCALL], key)
+    if perf is not None:
+        return perf
+
+    # same budget as the WARMUP_ROUNDS fixed rounds of NO_RUNS_AVG runs used
+    # before the adaptive sampling
+    maxruns = WARMUP_ROUNDS * NO_RUNS_AVG
+    stable = PERF_CI if PERF_CI is not None else PERF_STABLE_CV
+    samples = []
+    errs = 0
+    while len(samples) < maxruns:
+        (sample, errs) = perf_sample(str(ERRNO_ENOSYS), BASELINE_SYSCALL, errs, cpu)
+        samples.append(sample)
+        window = [e["perf"] for e in samples[-NO_RUNS_AVG:]]
+        if len(samples) >= NO_RUNS_AVG and \
+           perf_stats(window)[1] <= stable * abs(statistics.mean(window)):
+            break
+    debug("Baseline on CPU %d warmed up after %d runs" % (cpu, len(samples)))
+
+    perf = perf_measure(str(ERRNO_ENOSYS), BASELINE_SYSCALL, cpu,
+                        samples[-NO_RUNS_AVG:])
+    journal_record("baseline", str(ERRNO_ENOSYS), [BASELINE_SYSCALL], key, perf)
     return perf
 
+# return {CPU: baseline} for all CPUs of the pool
+def perf_baselines():
+    baselines = run_probes(perf_baseline, PERF_CPUS, show_progress=False)
+    return dict(zip(PERF_CPUS, baselines))
+
+# given an errno and a list of system calls, return a mapping of system calls
+# and resulting performance
+def explore_perf(errno, syscalls):
+    def measure(i, cpu):
+        perf = journal_lookup("perf", errno, [i])
+        # results are compared with the baseline of their CPU, which a
+        # resumed run with other --jobs or --perf-cpus may not have
+        if perf is None or perf.get("cpu") not in PERF_CPUS:
+            perf = perf_measure(errno, i, cpu)
+            journal_record("perf", errno, [i], [], perf)
+        return perf
+
+    perf = run_on_cpus(measure, syscalls)
+    progress_end()
+    return dict(zip(syscalls, perf))
+
 parser = argparse.ArgumentParser()
 parser.add_argument("-v", "--verbose", action="store_true", dest="verbose",
         help="enable debug output")
@@ -513,6 +2120,12 @@ parser.add_argument("-q", "--quiet", action="store_true", dest="quiet",
         help="disable any non-error output (non-error output will be provided through " + QUIET_LOG + ")")
 parser.add_argument("--no-strace", action="store_true", dest="nostrace",
         help="perform initial scan without strace (slower!)")
+parser.add_argument("--static-prune", action="store_true", dest="staticprune",
+        help="with --no-strace, only probe the system calls found by the static " +
+             "analysis, after checking a random sample of the others")
+parser.add_argument("--builtin-tracer", action="store_true", dest="builtintracer",
+        help="perform initial scan with seccomp-run's discovery mode instead of " +
+             "strace (faster, does not require a recent strace)")
 parser.add_argument("--output-sys-names", action="store_true", dest="outputnames",
         help="output system call names instead of numbers")
 parser.add_argument(CSV_OPT, action="store_true", dest="outputcsv",
@@ -521,16 +2134,84 @@ parser.add_argument("--partial-support", action="store_true",
         help="enable partial support analysis", dest="partialsupport")
 parser.add_argument("--perf-analysis", action="store_true",
         help="enable performance and resource usage analysis", dest="perfanalysis")
+parser.add_argument("--perf-cpus", type=str, dest="perfcpus",
+        help="CPUs to benchmark on (e.g., 2-4,7, or 'auto' for the isolated CPUs); " +
+             "with --jobs, benchmarks run concurrently on different CPUs " +
+             "(default: %d)" % TASKSET_CPU)
+parser.add_argument("--perf-numa", action="store_true", dest="perfnuma",
+        help="bind the memory of benchmarks to the NUMA node of their CPU (requires numactl)")
+parser.add_argument("--perf-counters", action="store_true", dest="perfcounters",
+        help="with --perf-analysis, also count instructions, cycles and page faults " +
+             "of the test binary during benchmarks (requires --cgroups)")
+parser.add_argument("--perf-ci", type=float, dest="perfci",
+        help="with --perf-analysis, benchmark each system call until the 95%% confidence " +
+             "interval of the mean is within +/- PERF_CI%% of the mean, instead of " +
+             "averaging %d runs" % NO_RUNS_AVG)
+parser.add_argument("--perf-max-runs", type=int, dest="perfmaxruns",
+        help="maximum number of benchmark runs per system call with --perf-ci " +
+             "(default %d)" % PERF_MAX_RUNS)
 parser.add_argument("--disable-static", action="store_true",
         help="disable the static analysis of the test binary", dest="nostatic")
 parser.add_argument("--timeout", type=int,
         help="test timeout (default %ds)" % TEST_TIMEOUT, dest="timeout")
+parser.add_argument("--ready-on", type=str, dest="readyon",
+        help="start testing as soon as the test binary is ready instead of waiting " +
+             "%ss: tcp:PORT, unix:PATH (listening socket), log:REGEX (output " % WAIT_STARTUP_TIME +
+             "line), pidfile:PATH, or exit (the binary terminated)")
 parser.add_argument("--smart-wait-repeat", type=int,
         help="enable smart wait (if you don't know what this does, don't enable it)", dest="smartwait")
 parser.add_argument("--test-sequential", action="store_true",
         help="run the binary first, then the test script with the binary's output", dest="seq")
+parser.add_argument("-j", "--jobs", type=int, dest="jobs",
+        help="number of probes to run concurrently (default %d); only use this if " % JOBS +
+             "several instances of the test binary can run side by side")
+parser.add_argument("--group-testing", action="store_true", dest="grouptesting",
+        help="probe batches of system calls at once and bisect the ones that fail " +
+             "(much faster when most system calls can be stubbed); with faking, " +
+             "the system calls of a batch that works are confirmed one by one")
+parser.add_argument("--no-early-abort", action="store_true", dest="noearlyabort",
+        help="let the test script conclude even if the test binary already crashed " +
+             "or exited with an error (for binaries that fail on purpose)")
+parser.add_argument("--netns", action="store_true", dest="netns",
+        help="run every probe in its own network namespace (requires root), so " +
+             "that --jobs can be used with a test binary that listens on a fixed port")
+parser.add_argument("--ptrace-stubs", action="store_true", dest="ptracestubs",
+        help="always use ptrace for path stubbing, not the seccomp " +
+             "user notification fd (which requires Linux >= 5.8)")
 parser.add_argument("--final-check", action="store_true",
         help="at the end of the analysis, check that sets can still be faked or stubbed as a whole", dest="fc")
+parser.add_argument("--journal", type=str, dest="journal",
+        help="record completed probes in this file, to be able to --resume")
+parser.add_argument("--resume", action="store_true", dest="resume",
+        help="skip the probes already recorded in the --journal file")
+parser.add_argument("--snapshot", action="store_true", dest="snapshot",
+        help="checkpoint the test binary with CRIU once it is ready and restore it " +
+             "to probe system calls that are only used after initialization " +
+             "(the restored binary does not write to the probe log)")
+parser.add_argument("--supervisor", action="store_true", dest="supervisor",
+        help="start and tear down probes through a persistent supervisor process " +
+             "(src/probe-supervisor) instead of forking from Python")
+parser.add_argument("--trace", type=str, dest="trace",
+        help="append a JSON record with the startup, test, teardown and retry " +
+             "times of every probe to this file")
+parser.add_argument("--time-report", action="store_true", dest="timereport",
+        help="at the end of the analysis, report where the time was spent, per phase")
+parser.add_argument("--cgroups", action="store_true", dest="cgroups",
+        help="track every probe in its own cgroup (v2) and tear it down with " +
+             "cgroup.kill instead of killall/pkill; requires write access to the " +
+             "cgroup hierarchy")
+parser.add_argument("--hit-accounting", action="store_true", dest="hitaccounting",
+        help="have seccomp-run count how many times each probe calls the system " +
+             "calls it stubs (recorded in the --trace records and --hit-log), and " +
+             "report the probes that work without calling them at all")
+parser.add_argument("--rerun-unhit", action="store_true", dest="rerununhit",
+        help="run the probes that work without calling the system calls they " +
+             "stub once more (implies --hit-accounting)")
+parser.add_argument("--hit-log", type=str, dest="hitlog",
+        help="append the hit counts of every probe to this CSV file " +
+             "(implies --hit-accounting)")
+parser.add_argument("--no-cache", action="store_true", dest="nocache",
+        help="do not reuse probe results of previous runs (cached in %s)" % CACHE_DIR)
 parser.add_argument("arg_binary", nargs='*',
         help="additional arguments to pass to the test binary")
 parser.add_argument("-t", dest="testscript",
@@ -553,6 +2234,21 @@ ENABLE_SEQUENTIAL = args.seq
 ENABLE_FINAL_CHECK = (args.fc is True)
 ENABLE_FASTSCAN = (args.nostrace is False)
 ENABLE_STATIC = (args.nostatic is False)
+STATIC_PRUNE = (args.staticprune is True)
+GROUP_TESTING = (args.grouptesting is True)
+EARLY_ABORT = (args.noearlyabort is False)
+ENABLE_NETNS = (args.netns is True)
+if args.ptracestubs:
+    USER_NOTIF = False
+ENABLE_CACHE = (args.nocache is False)
+ENABLE_SNAPSHOT = (args.snapshot is True)
+ENABLE_SUPERVISOR = (args.supervisor is True)
+ENABLE_CGROUPS = (args.cgroups is True)
+ENABLE_TIME_REPORT = (args.timereport is True)
+RERUN_UNHIT = (args.rerununhit is True)
+HIT_LOG_PATH = args.hitlog
+HIT_ACCOUNTING = (args.hitaccounting is True) or RERUN_UNHIT or \
+        HIT_LOG_PATH is not None
 PARTIAL_SUPPORT_ANALYSIS = (args.partialsupport is True)
 PERFORMANCE_ANALYSIS = (args.perfanalysis is True)
 OUTPUT_CSV = (args.outputcsv is True)
@@ -563,11 +2259,32 @@ common.ENABLE_QUIET = (args.quiet is True)
 if args.maxsys is not None:
     MAX_SYSCALL = args.maxsys
 
+if args.jobs is not None:
+    if args.jobs < 1:
+        error("--jobs must be at least 1.")
+        exit(1)
+    JOBS = args.jobs
+
 if args.smartwait is not None and args.smartwait > 1:
     SMART_WAIT_REPEAT = args.smartwait
 
+BUILTIN_TRACER = (args.builtintracer is True)
+if BUILTIN_TRACER and not ENABLE_FASTSCAN:
+    error("--builtin-tracer and --no-strace are incompatible.")
+    exit(1)
+
 ZBINARY = args.zbinary
-if ZBINARY is not None:
+if ZBINARY is not None and ENABLE_FASTSCAN and not BUILTIN_TRACER:
+    # strace cannot tell the processes that run the target binary apart
+    info("Scanning with the builtin tracer for --only-consider.")
+    BUILTIN_TRACER = True
+
+if ENABLE_FASTSCAN and not BUILTIN_TRACER and not strace_recent_enough():
+    print("WARN: strace is old on this system and does not support -n")
+    print("      without support for this option, the scan will be MUCH slower")
+    print("      you can get a proper recent strace from https://strace.io/")
+    print("      (or use --builtin-tracer)")
+    input("[ press ENTER to continue, or kill me to abort (CTRL-C) ]")
     ENABLE_FASTSCAN = False
 
 if common.ENABLE_VERBOSE and common.ENABLE_QUIET:
@@ -584,6 +2301,27 @@ if OUTPUT_CSV:
 if args.timeout is not None:
     TEST_TIMEOUT = args.timeout
 
+if args.perfci is not None:
+    PERF_CI = args.perfci / 100
+if args.perfmaxruns is not None:
+    PERF_MAX_RUNS = args.perfmaxruns
+
+if args.resume and args.journal is None:
+    error("--resume requires --journal.")
+    exit(1)
+
+if args.journal is not None:
+    journal_open(args.journal, args.resume)
+
+if args.trace is not None:
+    TRACE_PATH = os.path.abspath(args.trace)
+
+if args.readyon is not None:
+    READY_PROBE = parse_ready_probe(args.readyon)
+    if READY_PROBE is None:
+        error("Invalid --ready-on value: %s" % args.readyon)
+        exit(1)
+
 if TEST_TIMEOUT < 1:
     warning("Test timeout is very low, this might cause invalid test results!")
 
@@ -603,6 +2341,76 @@ if OUTPUT_CSV and (PARTIAL_SUPPORT_ANALYSIS or PERFORMANCE_ANALYSIS):
     error("CSV formatting not available with performance or partial analysis.")
     exit(1)
 
+if ENABLE_SUPERVISOR:
+    if not os.access(SUPERVISOR_PATH, os.X_OK):
+        error("%s not found, build it with 'make src/probe-supervisor'." % SUPERVISOR_PATH)
+        exit(1)
+    SUPERVISOR = Supervisor()
+
+if PERFORMANCE_ANALYSIS:
+    if args.perfcpus == "auto":
+        PERF_CPUS = discover_perf_cpus()
+    elif args.perfcpus is not None:
+        try:
+            PERF_CPUS = parse_cpu_list(args.perfcpus)
+        except(ValueError):
+            PERF_CPUS = []
+        if not len(PERF_CPUS) or not set(PERF_CPUS) <= os.sched_getaffinity(0):
+            error("Invalid or unavailable --perf-cpus: %s" % args.perfcpus)
+            exit(1)
+    else:
+        PERF_CPUS = default_perf_cpus()
+    # one benchmark per CPU at a time, and only as many as --jobs allows
+    PERF_CPUS = PERF_CPUS[:JOBS]
+    if len(PERF_CPUS) > 1 and not ENABLE_NETNS:
+        # e.g., servers on a fixed port would collide
+        error("Concurrent benchmarks (--perf-analysis with --jobs) require --netns.")
+        exit(1)
+    PERF_CPU_POOL = queue.Queue()
+    for cpu in PERF_CPUS:
+        PERF_CPU_POOL.put(cpu)
+    debug("Benchmarking on CPU(s) %s" % ",".join(map(str, PERF_CPUS)))
+
+    PERF_NUMA = (args.perfnuma is True)
+    PERF_COUNTERS = (args.perfcounters is True)
+    if PERF_COUNTERS and not ENABLE_CGROUPS:
+        error("--perf-counters requires --cgroups.")
+        exit(1)
+    if PERF_NUMA and shutil.which("numactl") is None:
+        error("--perf-numa requires numactl, which is not installed.")
+        exit(1)
+
+if ENABLE_NETNS:
+    for tool in ["unshare", "nsenter", "ip"]:
+        if shutil.which(tool) is None:
+            error("--netns requires %s, which is not installed." % tool)
+            exit(1)
+    if ZBINARY is not None or ENABLE_SNAPSHOT:
+        error("--netns is not compatible with --only-consider and --snapshot.")
+        exit(1)
+
+if ENABLE_CGROUPS and not cgroup_setup():
+    error("--cgroups requires a writable cgroup v2 hierarchy with cgroup.kill " +
+          "(Linux 5.14+).")
+    exit(1)
+
+if ENABLE_SNAPSHOT:
+    if shutil.which(CRIU_BINARY) is None:
+        error("--snapshot requires criu, which is not installed.")
+        exit(1)
+    if not ENABLE_FASTSCAN or ENABLE_SEQUENTIAL:
+        error("--snapshot requires the strace scan and is not compatible " +
+              "with --test-sequential.")
+        exit(1)
+    if JOBS > 1:
+        # restored programs keep the pids of the snapshot
+        error("--snapshot is not compatible with --jobs.")
+        exit(1)
+
+if ENABLE_FASTSCAN and STATIC_PRUNE:
+    error("--static-prune only applies to the scan without strace (--no-strace).")
+    exit(1)
+
 if not ENABLE_FASTSCAN and PARTIAL_SUPPORT_ANALYSIS:
     error("Partial system call support exploration only " +
           "available with strace (and --no-strace was passed).")
@@ -615,6 +2423,7 @@ used = []
 features = []
 files = []
 if ENABLE_FASTSCAN:
+    set_phase("strace scan")
     start_time = time.time()
     ret = initial_strace_scan()
     end_time = time.time()
@@ -625,37 +2434,39 @@ if ENABLE_FASTSCAN:
     info("Fast scan done!")
     info("Traced %d syscalls, estimated total (worst case) test time: %s" % (len(ret[0]), str(datetime.timedelta(seconds=end_time-start_time)*len(ret[0]*2))))
 else:
-    unused = explore_works("crash", all_syscalls)
-    used = list(set(all_syscalls) - unused)
+    set_phase("crash scan")
+    candidates = all_syscalls
+    if STATIC_PRUNE:
+        candidates = static_prune(all_syscalls)
+    unused = explore_works("crash", candidates)
+    used = list(set(candidates) - unused)
 used.sort()
 
-info("Finding system calls that work with ENOSYS...")
+if JOBS > 1:
+    # the two passes are independent, run them side by side
+    info("Finding system calls that work with ENOSYS and when we fake (errno = 0)...")
+    set_phase("ENOSYS+fake")
 
-probably_works_stubbed = list(explore_works(str(ERRNO_ENOSYS), used))
-probably_works_stubbed.sort()
+    works = explore_works_combined([str(ERRNO_ENOSYS), "0"], used)
+    probably_works_stubbed = sorted(works[str(ERRNO_ENOSYS)])
+    probably_works_lying = sorted(works["0"])
+else:
+    info("Finding system calls that work with ENOSYS...")
+    set_phase("ENOSYS pass")
 
-if (ENABLE_FINAL_CHECK):
-    log = get_temp_file()
-    (u, s, r) = analyze_one_pass(str(ERRNO_ENOSYS), probably_works_stubbed, log, 0)
-    if u:
-        info("Final check analysis for stubbing succeeded; the entire set can be stubbed simultaneously.")
-    else:
-        warning("Final check analysis for stubbing failed; the entire set cannot be stubbed simultaneously.")
-        warning("We recommend a manual pass with seccomp_run to find the culprit.")
+    probably_works_stubbed = list(explore_works(str(ERRNO_ENOSYS), used))
+    probably_works_stubbed.sort()
 
-info("Finding system calls that work when we fake (errno = 0)...")
+    info("Finding system calls that work when we fake (errno = 0)...")
+    set_phase("fake pass")
 
-probably_works_lying = list(explore_works("0", used))
-probably_works_lying.sort()
+    probably_works_lying = list(explore_works("0", used))
+    probably_works_lying.sort()
 
 if (ENABLE_FINAL_CHECK):
-    log = get_temp_file()
-    (u, s, r) = analyze_one_pass("0", probably_works_lying, log, 0)
-    if u:
-        info("Final check analysis for faking succeeded; the entire set can be faked simultaneously.")
-    else:
-        warning("Final check analysis for faking failed; the entire set cannot be faked simultaneously.")
-        warning("We recommend a manual pass with seccomp_run to find the culprit.")
+    set_phase("final check")
+    final_check(str(ERRNO_ENOSYS), probably_works_stubbed, "stubbing", "stubbed")
+    final_check("0", probably_works_lying, "faking", "faked")
 
 require_impl = list(((set(used)) - set(probably_works_stubbed)) - set(probably_works_lying))
 require_impl.sort()
@@ -672,6 +2483,7 @@ probably_works_lying_and_impled = list(set(probably_works_lying) -
                                        set(probably_works_stubbed))
 probably_works_lying_and_impled.sort()
 
+set_phase("output")
 if not OUTPUT_CSV:
     print_header("Usage analysis")
 
@@ -721,6 +2533,7 @@ else:
                 isused, canfake, canstub, canboth))
 
 if ENABLE_STATIC:
+    set_phase("static")
     info("Finding used system calls using static analysis...")
 
     # In "consider-only" mode, it is the binary to be considered that we should
@@ -732,10 +2545,10 @@ if ENABLE_STATIC:
     if (OUTPUT_CSV):
         print()
 
-    runcmd = [str(os.path.join(os.path.realpath(os.path.dirname(__file__)),
-            "src/static-binary-analyser/static_analyser.py")), "-a", str(binary_path),
-            "--csv=true", "--display=false", "--verbose=false"]
-    print(subprocess.check_output(runcmd).decode('utf-8'))
+    if STATIC_ANALYSER_OUTPUT is None:
+        STATIC_ANALYSER_OUTPUT = subprocess.check_output(
+                static_analyser_cmd(binary_path)).decode('utf-8')
+    print(STATIC_ANALYSER_OUTPUT)
 else:
     info("Skipping static analysis...")
 
@@ -751,10 +2564,11 @@ def print_set(s, printer):
     keys.sort()
     for syscall in keys:
         print(syscall + ": ", end="")
-        printer(s, syscall)
+        printer(sorted(s[syscall]), syscall)
     print()
 
 if PARTIAL_SUPPORT_ANALYSIS:
+    set_phase("partial")
     def print_values(l, sys):
         def print_value(f, e):
             if f in FEATURE_TRANSLATIONS[sys]:
@@ -839,47 +2653,65 @@ if PARTIAL_SUPPORT_ANALYSIS:
     print_set(works_partial_stubbed_and_faked, print_values)
 
 if PERFORMANCE_ANALYSIS:
-    def print_perf(p, baseline):
+    set_phase("perf")
+    # resources of the whole process tree, relative to the baseline
+    def print_resources(v, baseline_perf):
+        res = [k for k in RESOURCE_METRICS if k in v]
+        if len(res):
+            print("    " + ", ".join(["%s %s (%s)" % (k, str(round(v[k], 2)),
+                    str(round(v[k] / baseline_perf[k], 2)) if baseline_perf.get(k) else "-")
+                    for k in res]))
+
+    def print_perf(p, baselines):
         if BEAUTIFY_PERF_OUTPUT:
-            print("syscall: perf openfds memusage (relative to the baseline)")
+            print("syscall: perf openfds memusage (relative to the baseline) " +
+                  "[perf stddev, 95% CI, runs]")
             for k, v in p.items():
-                print(str(format_syscall_list([k])[0]) + ": %s %s %s (%s,%s,%s)" %
+                # compare to the baseline of the same CPU
+                baseline_perf = baselines[v.get("cpu", PERF_CPUS[0])]
+                print(str(format_syscall_list([k])[0]) + ": %s %s %s (%s,%s,%s) [%s, +/-%s, %d]" %
                         (str(round(v["perf"], 2)),
                         str(round(v["openfds"], 2)),
                         str(round(v["memusage"], 2)),
                         str(round(v["perf"] / baseline_perf["perf"], 2)),
                         str(round(v["openfds"] / baseline_perf["openfds"], 2)),
-                        str(round(v["memusage"] / baseline_perf["memusage"], 2))))
+                        str(round(v["memusage"] / baseline_perf["memusage"], 2)),
+                        str(round(v["stddev"], 2)), str(round(v["ci"], 2)), v["runs"]))
+                print_resources(v, baseline_perf)
             print()
         else:
-            print({format_syscall_list([k])["perf"]: v for k, v in p.items()})
+            print({format_syscall_list([k])[0]: v for k, v in p.items()})
 
     print_header("Performance analysis")
 
     info("Determining baseline...")
-    # this is NOT a copy and paste error, do it three times to warm up
-    # this has a significant impact on performance
-    baseline_raw = []
-    for i in range(WARMUP_ROUNDS): # = WARMUP_ROUNDS + 1 runs
-        baseline_raw = explore_perf(str(ERRNO_ENOSYS), [317])
-    baseline_perf = baseline_raw[317]
+    # warming up has a significant impact on performance
+    baselines = perf_pass(perf_baselines)
 
     if BEAUTIFY_PERF_OUTPUT:
-        print("Baseline: perf openfds memusage")
-        print("Baseline: %s %s %s" % (str(round(baseline_perf["perf"], 2)),
+        print("Baseline: perf openfds memusage [perf stddev, 95% CI, runs]")
+        for (cpu, baseline_perf) in baselines.items():
+            print("Baseline%s: %s %s %s [%s, +/-%s, %d]" % (
+                                     " (CPU %d)" % cpu if len(baselines) > 1 else "",
+                                     str(round(baseline_perf["perf"], 2)),
                                      str(round(baseline_perf["openfds"], 2)),
-                                     str(round(baseline_perf["memusage"], 2))))
+                                     str(round(baseline_perf["memusage"], 2)),
+                                     str(round(baseline_perf["stddev"], 2)),
+                                     str(round(baseline_perf["ci"], 2)),
+                                     baseline_perf["runs"]))
+            print_resources(baseline_perf, baseline_perf)
         print()
 
     info("Gathering data for stubbing...")
-    stubbing_perf = explore_perf(str(ERRNO_ENOSYS), probably_works_stubbed)
-    print_perf(stubbing_perf, baseline_perf)
+    stubbing_perf = perf_pass(explore_perf, str(ERRNO_ENOSYS), probably_works_stubbed)
+    print_perf(stubbing_perf, baselines)
 
     info("Gathering data for faking...")
-    faking_perf = explore_perf("0", probably_works_lying)
-    print_perf(faking_perf, baseline_perf)
+    faking_perf = perf_pass(explore_perf, "0", probably_works_lying)
+    print_perf(faking_perf, baselines)
 
 if SPECIAL_FILES_ANALYSIS:
+    set_phase("special files")
     def print_values(l, x): # x is ignored
         if not len(l):
             print ("-")
@@ -957,3 +2789,9 @@ if SPECIAL_FILES_ANALYSIS:
     print("Files that may be faked and stubbed (%d/%d):" %
             (lengthof(works_partial_stubbed_and_faked), lengthof(features)))
     print_set(works_partial_stubbed_and_faked, print_values)
+
+set_phase(None)
+report_retries()
+report_unhit()
+report_time()
+cache_evict()
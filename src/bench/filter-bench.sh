@@ -0,0 +1,55 @@
+#!/bin/bash
+
+# SPDX-License-Identifier: BSD-3-Clause
+#
+# Authors: Hugo Lefeuvre <hugo.lefeuvre@manchester.ac.uk>
+#
+# Copyright (c) 2020-2023, The University of Manchester. All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+#
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+# 3. Neither the name of the copyright holder nor the names of its
+#    contributors may be used to endorse or promote products derived from
+#    this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+# Filter evaluation microbenchmark: ns per filtered system call under
+# seccomp-run for growing system call sets, with the linear chain (-l) and
+# the default binary search tree. The sets use every other number from 1000
+# so that no two system calls merge into a range (worst case for the tree),
+# and end with the (nonexistent) system call that filter-bench makes.
+
+cd "$(dirname "$0")/../.."
+
+SECCOMPRUN=src/seccomp-run
+BENCH=src/bench/filter-bench
+ITERATIONS=${ITERATIONS:-1000000}
+NR=4000
+
+printf "%-8s %12s %12s\n" "#sys" "linear (ns)" "tree (ns)"
+printf "%-8s %12s %12s\n" "none" "$($BENCH $ITERATIONS $NR)" "-"
+
+for n in 1 10 50 100 200 400; do
+    set="$(seq 1000 2 $((1000 + 2 * (n - 2)))) $NR"
+    linear=$($SECCOMPRUN -q -l -e 38 -n $n $set -- $BENCH $ITERATIONS $NR)
+    tree=$($SECCOMPRUN -q -e 38 -n $n $set -- $BENCH $ITERATIONS $NR)
+    printf "%-8s %12s %12s\n" "$n" "$linear" "$tree"
+done
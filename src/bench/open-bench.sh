@@ -0,0 +1,57 @@
+#!/bin/bash
+
+# SPDX-License-Identifier: BSD-3-Clause
+#
+# Authors: Hugo Lefeuvre <hugo.lefeuvre@manchester.ac.uk>
+#
+# Copyright (c) 2020-2023, The University of Manchester. All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+#
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+# 3. Neither the name of the copyright holder nor the names of its
+#    contributors may be used to endorse or promote products derived from
+#    this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+# Trapped open() microbenchmark: ns per openat() under seccomp-run -t, with
+# the path read word by word (-P, PTRACE_PEEKDATA), in one process_vm_readv
+# (default), and with the user notification backend (-u), for a short and a
+# long path.
+
+cd "$(dirname "$0")/../.."
+
+SECCOMPRUN=src/seccomp-run
+BENCH=src/bench/open-bench
+ITERATIONS=${ITERATIONS:-20000}
+LONG=/tmp/loupe-open-bench/$(printf 'x%.0s' $(seq 200))/file
+
+mkdir -p "$(dirname $LONG)" && touch $LONG
+
+printf "%-8s %10s %10s %10s %10s\n" "path" "none (ns)" "-P (ns)" "readv (ns)" "-u (ns)"
+for path in /etc/hostname $LONG; do
+    none=$($BENCH $ITERATIONS $path)
+    peek=$($SECCOMPRUN -q -P -e 2 -t 1 /nonexistent -n 1 257 -- $BENCH $ITERATIONS $path)
+    readv=$($SECCOMPRUN -q -e 2 -t 1 /nonexistent -n 1 257 -- $BENCH $ITERATIONS $path)
+    notif=$($SECCOMPRUN -q -u -e 2 -t 1 /nonexistent -n 1 257 -- $BENCH $ITERATIONS $path)
+    printf "%-8s %10s %10s %10s %10s\n" "${#path}B" "$none" "$peek" "$readv" "$notif"
+done
+
+rm -rf /tmp/loupe-open-bench
@@ -0,0 +1,476 @@
+/* SPDX-License-Identifier: BSD-3-Clause */
+/*
+ * Copyright (c) 2020-2022, Hugo Lefeuvre <hugo.lefeuvre@manchester.ac.uk>
+ *
+ * Redistribution and use in source and binary forms, with or without
+ * modification, are permitted provided that the following conditions
+ * are met:
+ *
+ * 1. Redistributions of source code must retain the above copyright
+ *    notice, this list of conditions and the following disclaimer.
+ * 2. Redistributions in binary form must reproduce the above copyright
+ *    notice, this list of conditions and the following disclaimer in the
+ *    documentation and/or other materials provided with the distribution.
+ * 3. Neither the name of the copyright holder nor the names of its
+ *    contributors may be used to endorse or promote products derived from
+ *    this software without specific prior written permission.
+ *
+ * THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+ * AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+ * IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+ * ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+ * LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+ * CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+ * SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+ * INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+ * CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+ * ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+ * POSSIBILITY OF SUCH DAMAGE.
+ */
+
+/*
+ * Long-lived probe supervisor for explore.py.
+ *
+ * explore.py sends one command per line on stdin, fields separated by tabs,
+ * and gets replies on stdout, also one per line. Every command refers to a
+ * probe by an id chosen by explore.py. Replies to 'wait' and 'kill' may come
+ * out of order, the id tells which probe they are about.
+ *
+ *   run <id> <log> <arg0> [<arg1> ...]
+ *       start arg0 in a new session, stdout/stderr appended to log
+ *       -> ok <id> <pid> | err <id> <message>
+ *   runin <id> <cgroup> <log> <arg0> [<arg1> ...]
+ *       same as run, but in the given cgroup (v2) directory
+ *   wait <id> <timeout in ms, -1 for none>
+ *       -> exited <id> <wait status> <utime us> <stime us> <maxrss kB>
+ *        | running <id> (timeout)
+ *   kill <id>
+ *       kill the process tree of the probe and forget about it
+ *       -> exited <id> <wait status> <utime us> <stime us> <maxrss kB>
+ *   quit
+ *
+ * The supervisor is a child subreaper, so processes that escape the process
+ * group and session of a probe still end up as our children and get reaped.
+ */
+
+#include <errno.h>
+#include <fcntl.h>
+#include <poll.h>
+#include <signal.h>
+#include <stdio.h>
+#include <stdlib.h>
+#include <string.h>
+#include <dirent.h>
+#include <limits.h>
+#include <time.h>
+#include <unistd.h>
+#include <sys/prctl.h>
+#include <sys/resource.h>
+#include <sys/signalfd.h>
+#include <sys/wait.h>
+
+#define MAX_PROBES	256
+#define MAX_ARGS	1024
+#define LINE_MAX_LEN	65536
+
+struct probe {
+    int used;
+    long id;
+    pid_t pid;
+
+    int exited;
+    int status;
+    struct rusage rusage;
+
+    /* a wait or kill is pending, reply when exited or at deadline */
+    int waiting;
+    int killing;
+    long long deadline; /* ms, -1 for none */
+};
+
+static struct probe probes[MAX_PROBES];
+
+#define error(...) \
+  do { fprintf(stderr, "[E] " __VA_ARGS__); } while (0);
+
+static long long
+now_ms(void)
+{
+    struct timespec ts;
+    clock_gettime(CLOCK_MONOTONIC, &ts);
+    return ts.tv_sec * 1000LL + ts.tv_nsec / 1000000;
+}
+
+static struct probe *
+find_probe(long id)
+{
+    for (int i = 0; i < MAX_PROBES; i++) {
+        if (probes[i].used && probes[i].id == id)
+            return &probes[i];
+    }
+    return NULL;
+}
+
+/* number of running probes, other than the one rooted at root */
+static int
+other_active_probes(pid_t root)
+{
+    int n = 0;
+    for (int i = 0; i < MAX_PROBES; i++) {
+        if (probes[i].used && !probes[i].exited && probes[i].pid != root)
+            n++;
+    }
+    return n;
+}
+
+static int
+is_probe_root(pid_t pid)
+{
+    for (int i = 0; i < MAX_PROBES; i++) {
+        if (probes[i].used && probes[i].pid == pid)
+            return 1;
+    }
+    return 0;
+}
+
+static void
+reply_exited(struct probe *p)
+{
+    printf("exited\t%ld\t%d\t%lld\t%lld\t%ld\n", p->id, p->status,
+           p->rusage.ru_utime.tv_sec * 1000000LL + p->rusage.ru_utime.tv_usec,
+           p->rusage.ru_stime.tv_sec * 1000000LL + p->rusage.ru_stime.tv_usec,
+           p->rusage.ru_maxrss);
+    fflush(stdout);
+}
+
+/* reap all dead children, recording the status of probe roots */
+static void
+reap(void)
+{
+    pid_t pid;
+    int status;
+    struct rusage rusage;
+
+    while ((pid = wait4(-1, &status, WNOHANG | __WALL, &rusage)) > 0) {
+        for (int i = 0; i < MAX_PROBES; i++) {
+            if (probes[i].used && probes[i].pid == pid) {
+                probes[i].exited = 1;
+                probes[i].status = status;
+                probes[i].rusage = rusage;
+            }
+        }
+    }
+}
+
+/* kill everything in the process group or session of a probe; the probe
+ * was started with setsid, so both are identified by its pid */
+static void
+kill_tree(pid_t root)
+{
+    char path[64];
+    char buf[1024];
+    DIR *proc;
+    struct dirent *e;
+
+    kill(-root, SIGKILL);
+
+    proc = opendir("/proc");
+    if (proc == NULL)
+        return;
+
+    while ((e = readdir(proc)) != NULL) {
+        pid_t pid = strtol(e->d_name, NULL, 10);
+        if (pid <= 0)
+            continue;
+
+        snprintf(path, sizeof(path), "/proc/%d/stat", pid);
+        int fd = open(path, O_RDONLY);
+        if (fd < 0)
+            continue;
+        ssize_t n = read(fd, buf, sizeof(buf) - 1);
+        close(fd);
+        if (n <= 0)
+            continue;
+        buf[n] = 0;
+
+        /* the command name may contain spaces, skip past it */
+        char *s = strrchr(buf, ')');
+        char state;
+        int ppid, pgrp, session;
+        if (s == NULL ||
+            sscanf(s + 1, " %c %d %d %d", &state, &ppid, &pgrp, &session) != 4)
+            continue;
+
+        if (pgrp == root || session == root) {
+            kill(pid, SIGKILL);
+        } else if (ppid == getpid() && !is_probe_root(pid) &&
+                   other_active_probes(root) == 0) {
+            /* escaped both; if no other probe is running, it can only be
+             * one of the processes of this probe */
+            kill(pid, SIGKILL);
+        }
+    }
+    closedir(proc);
+}
+
+static void
+free_probe(struct probe *p)
+{
+    memset(p, 0, sizeof(*p));
+}
+
+/* move the calling process to a cgroup v2 */
+static int
+join_cgroup(const char *cgroup)
+{
+    char path[PATH_MAX];
+
+    snprintf(path, sizeof(path), "%s/cgroup.procs", cgroup);
+    int fd = open(path, O_WRONLY);
+    if (fd < 0)
+        return -1;
+    int ret = (write(fd, "0", 1) == 1) ? 0 : -1;
+    close(fd);
+    return ret;
+}
+
+static void
+cmd_run(long id, const char *cgroup, char *log, char **argv)
+{
+    struct probe *p = NULL;
+
+    for (int i = 0; i < MAX_PROBES; i++) {
+        if (!probes[i].used) {
+            p = &probes[i];
+            break;
+        }
+    }
+
+    if (p == NULL || find_probe(id) != NULL) {
+        printf("err\t%ld\t%s\n", id, p == NULL ? "too many probes" : "duplicate id");
+        fflush(stdout);
+        return;
+    }
+
+    pid_t pid = fork();
+    if (pid == -1) {
+        printf("err\t%ld\tfork: %s\n", id, strerror(errno));
+        fflush(stdout);
+        return;
+    } else if (pid == 0) {
+        sigset_t set;
+        sigemptyset(&set);
+        sigprocmask(SIG_SETMASK, &set, NULL);
+        prctl(PR_SET_PDEATHSIG, 0);
+        setsid();
+
+        if (cgroup != NULL && join_cgroup(cgroup) < 0) {
+            perror("cgroup");
+            _exit(127);
+        }
+
+        int in = open("/dev/null", O_RDONLY);
+        int out = open(log, O_WRONLY | O_CREAT | O_APPEND, 0644);
+        if (in < 0 || out < 0) {
+            perror("open");
+            _exit(127);
+        }
+        dup2(in, 0);
+        dup2(out, 1);
+        dup2(out, 2);
+        close(in);
+        close(out);
+
+        execvp(argv[0], argv);
+        perror("execvp");
+        _exit(127);
+    }
+
+    p->used = 1;
+    p->id = id;
+    p->pid = pid;
+    printf("ok\t%ld\t%d\n", id, pid);
+    fflush(stdout);
+}
+
+static void
+cmd_wait(long id, long timeout)
+{
+    struct probe *p = find_probe(id);
+
+    if (p == NULL) {
+        printf("err\t%ld\tno such probe\n", id);
+        fflush(stdout);
+        return;
+    }
+
+    p->waiting = 1;
+    p->deadline = (timeout < 0) ? -1 : now_ms() + timeout;
+}
+
+static void
+cmd_kill(long id)
+{
+    struct probe *p = find_probe(id);
+
+    if (p == NULL) {
+        printf("err\t%ld\tno such probe\n", id);
+        fflush(stdout);
+        return;
+    }
+
+    kill_tree(p->pid);
+    p->killing = 1;
+}
+
+/* answer pending waits and kills that can be answered; return the time in
+ * ms until the next wait deadline, -1 if none */
+static int
+process_pending(void)
+{
+    long long now = now_ms();
+    long long next = -1;
+
+    for (int i = 0; i < MAX_PROBES; i++) {
+        struct probe *p = &probes[i];
+        if (!p->used)
+            continue;
+
+        if (p->killing && p->exited) {
+            reply_exited(p);
+            free_probe(p);
+        } else if (p->waiting && p->exited) {
+            p->waiting = 0;
+            reply_exited(p);
+        } else if (p->waiting && p->deadline >= 0 && p->deadline <= now) {
+            p->waiting = 0;
+            printf("running\t%ld\n", p->id);
+            fflush(stdout);
+        } else if (p->waiting && p->deadline >= 0) {
+            if (next < 0 || p->deadline - now < next)
+                next = p->deadline - now;
+        }
+    }
+
+    return next;
+}
+
+static void
+handle_line(char *line)
+{
+    char *argv[MAX_ARGS + 1];
+    int argc = 0;
+    char *saveptr;
+
+    for (char *tok = strtok_r(line, "\t", &saveptr); tok != NULL && argc < MAX_ARGS;
+         tok = strtok_r(NULL, "\t", &saveptr)) {
+        argv[argc++] = tok;
+    }
+    argv[argc] = NULL;
+
+    if (argc == 0)
+        return;
+
+    if (strcmp(argv[0], "quit") == 0) {
+        for (int i = 0; i < MAX_PROBES; i++) {
+            if (probes[i].used)
+                kill_tree(probes[i].pid);
+        }
+        exit(EXIT_SUCCESS);
+    }
+
+    if (argc < 2) {
+        error("Malformed command '%s'.\n", argv[0]);
+        return;
+    }
+
+    long id = strtol(argv[1], NULL, 10);
+    if (strcmp(argv[0], "run") == 0 && argc >= 4) {
+        cmd_run(id, NULL, argv[2], &argv[3]);
+    } else if (strcmp(argv[0], "runin") == 0 && argc >= 5) {
+        cmd_run(id, argv[2], argv[3], &argv[4]);
+    } else if (strcmp(argv[0], "wait") == 0 && argc == 3) {
+        cmd_wait(id, strtol(argv[2], NULL, 10));
+    } else if (strcmp(argv[0], "kill") == 0 && argc == 2) {
+        cmd_kill(id);
+    } else {
+        error("Malformed command '%s'.\n", argv[0]);
+    }
+}
+
+int
+main(int argc, char **argv)
+{
+    static char buf[LINE_MAX_LEN];
+    size_t len = 0;
+    sigset_t set;
+
+    /* die with explore.py */
+    prctl(PR_SET_PDEATHSIG, SIGKILL);
+    /* adopt the processes that escape probe process groups */
+    prctl(PR_SET_CHILD_SUBREAPER, 1);
+
+    sigemptyset(&set);
+    sigaddset(&set, SIGCHLD);
+    sigprocmask(SIG_BLOCK, &set, NULL);
+    int sfd = signalfd(-1, &set, SFD_CLOEXEC);
+    if (sfd == -1) {
+        perror("signalfd");
+        exit(EXIT_FAILURE);
+    }
+
+    while (1) {
+        struct pollfd fds[2] = {
+            { .fd = 0, .events = POLLIN },
+            { .fd = sfd, .events = POLLIN },
+        };
+
+        reap();
+        int timeout = process_pending();
+
+        if (poll(fds, 2, timeout) == -1) {
+            if (errno == EINTR)
+                continue;
+            perror("poll");
+            exit(EXIT_FAILURE);
+        }
+
+        if (fds[1].revents & POLLIN) {
+            /* SIGCHLDs coalesce, reap() takes care of all dead children */
+            struct signalfd_siginfo si;
+            if (read(sfd, &si, sizeof(si)) != sizeof(si))
+                perror("read(signalfd)");
+        }
+
+        if (fds[0].revents & (POLLIN | POLLHUP)) {
+            ssize_t n = read(0, buf + len, sizeof(buf) - len - 1);
+            if (n <= 0) {
+                /* explore.py went away, take everything down with us */
+                for (int i = 0; i < MAX_PROBES; i++) {
+                    if (probes[i].used)
+                        kill_tree(probes[i].pid);
+                }
+                exit(EXIT_SUCCESS);
+            }
+            len += n;
+            buf[len] = 0;
+
+            char *start = buf;
+            char *nl;
+            while ((nl = strchr(start, '\n')) != NULL) {
+                *nl = 0;
+                handle_line(start);
+                start = nl + 1;
+            }
+            len -= start - buf;
+            memmove(buf, start, len);
+
+            if (len == sizeof(buf) - 1) {
+                error("Command too long, dropping it.\n");
+                len = 0;
+            }
+        }
+    }
+
+    return 0;
+}
@@ -28,6 +28,9 @@
  * POSSIBILITY OF SUCH DAMAGE.
  */
 
+/* process_vm_readv */
+#define _GNU_SOURCE
+
 #include <errno.h>
 #include <stddef.h>
 #include <stdio.h>
@@ -36,11 +39,17 @@
 #include <stdint.h>
 #include <unistd.h>
 #include <ctype.h>
+#include <signal.h>
+#include <poll.h>
+#include <fcntl.h>
 #include <linux/audit.h>
 #include <linux/filter.h>
 #include <linux/seccomp.h>
 #include <linux/limits.h>
 #include <sys/prctl.h>
+#include <sys/ioctl.h>
+#include <sys/socket.h>
+#include <sys/uio.h>
 #include <sys/syscall.h>
 #include <sys/ptrace.h>
 #include <sys/wait.h>
@@ -56,6 +65,16 @@
 #define DO_PARTIALSTUB	0x8
 #define DO_CHECKPATH	0x10
 #define DO_PATHSTUB	0x20
+/* DO_USERNOTIF replaces DO_PTRACE */
+#define DO_USERNOTIF	0x40
+/* DO_DISCOVER records system calls instead of stubbing them */
+#define DO_DISCOVER	0x80
+/* DO_INJECT: with DO_CHECKPATH, the filter is only installed in processes
+ * running the target binary, by the tracer at exec time; it returns
+ * SECCOMP_RET_TRACE, as it outlives execs of other binaries */
+#define DO_INJECT	0x100
+/* DO_COUNT: count the stubbed calls (-c), which requires a supervisor */
+#define DO_COUNT	0x200
 #define SETF(N, F)	(N) = ((N) | (F))
 #define ISSET(N, F)	(((N) & (F)) != 0)
 #define PATH_MAX 2048
@@ -66,6 +85,52 @@ static int DEBUG = 0;
 /* only valid when DO_CHECKPATH set */
 static char EXECUTABLE_PATH[PATH_MAX + 1] = {0};
 
+/* only valid when DO_DISCOVER set: where to record, one JSON object per
+ * line and per new system call, argument value (-a) or path (-s), as soon
+ * as we see them (we may get killed at any time) */
+static FILE *DISCOVERY_OUT = NULL;
+
+struct watched_arg {
+    int nr, pos, is_path;
+};
+static struct watched_arg WATCHED[64];
+static int NWATCHED = 0;
+
+struct seen_arg {
+    int nr, pos;
+    unsigned long val;
+    char *path;
+};
+static struct seen_arg *SEEN_ARGS = NULL;
+static int NSEEN_ARGS = 0;
+
+#define MAX_SEEN_NR	1024
+static unsigned char SEEN_NR[MAX_SEEN_NR] = {0};
+
+/* only valid when DO_INJECT set: the filter to inject */
+static struct sock_fprog INJECT_PROG;
+
+/* what we know about the processes that we trace, valid until they exec:
+ * whether they run the target binary (-1: unknown, 0: yes, 1: no, see
+ * ptracer_check_path()) and whether they have the filter (DO_INJECT) */
+struct proc_state {
+    pid_t pid;
+    int exe;
+    int filtered;
+};
+static struct proc_state *PROCS = NULL;
+static int NPROCS = 0;
+
+/* only valid when DO_COUNT set: how many times each system call of the set
+ * was stubbed, kept up to date in STATS_FD (we may get killed at any time)
+ * as one fixed-width "<syscall number> <hits>" line per system call */
+#define STATS_LINE_FMT	"%6d %12lu\n"
+#define STATS_LINE_LEN	20
+static int STATS_FD = -1;
+static int *HITS_NR = NULL;
+static unsigned long *HITS = NULL;
+static int NHITS = 0;
+
 #define debug(...) \
   do { if (DEBUG)  { fprintf(stderr, "[D] " __VA_ARGS__); }} while (0);
 
@@ -75,109 +140,311 @@ static char EXECUTABLE_PATH[PATH_MAX + 1] = {0};
 #define error(...) \
   do { fprintf(stderr, "[E] " __VA_ARGS__); } while (0);
 
+static void
+stats_write(int i)
+{
+    char line[STATS_LINE_LEN + 1];
+
+    snprintf(line, sizeof(line), STATS_LINE_FMT, HITS_NR[i], HITS[i]);
+    if (pwrite(STATS_FD, line, STATS_LINE_LEN, (off_t) i * STATS_LINE_LEN)
+            != STATS_LINE_LEN)
+        perror("pwrite");
+}
+
+/* write the stats file with zero hits for the whole set */
+static void
+stats_init(int num, int *syscalls)
+{
+    HITS_NR = malloc(sizeof(int) * num);
+    memcpy(HITS_NR, syscalls, sizeof(int) * num);
+    HITS = calloc(num, sizeof(unsigned long));
+    NHITS = num;
+
+    for (int i = 0; i < num; i++)
+        stats_write(i);
+}
+
+static void
+count_hit(long nr)
+{
+    if (!HITS)
+        return;
+
+    for (int i = 0; i < NHITS; i++) {
+        if (HITS_NR[i] == nr) {
+            HITS[i]++;
+            stats_write(i);
+            return;
+        }
+    }
+}
+
+/* compile the system call set into a balanced binary search tree over
+ * ranges of contiguous numbers instead of a linear chain (see -l) */
+static int LINEAR_FILTER = 0;
+
+struct nr_range {
+    unsigned int lo, hi;
+};
+
+static int
+compare_nr(const void *a, const void *b)
+{
+    unsigned int x = *(const int *) a, y = *(const int *) b;
+    return (x > y) - (x < y);
+}
+
+/* number of instructions of the subtree for ranges [l, r) */
 static int
-install_filter(int num, int *syscalls, int flags, int f_errno)
+tree_size(struct nr_range *ranges, int l, int r)
+{
+    int mid, left;
+
+    if (r - l == 1)
+        return (ranges[l].lo == ranges[l].hi) ? 3 : 4;
+
+    mid = (l + r) / 2;
+    left = tree_size(ranges, l, mid);
+    /* conditional jumps only have 8 bits of offset */
+    return ((left > 255) ? 2 : 1) + left + tree_size(ranges, mid, r);
+}
+
+/* emit the subtree for ranges [l, r) at pos, return the next instruction;
+ * the accumulator holds the system call number. Leaves return on their own
+ * so that no jump ever has to cross the tree. */
+static struct sock_filter *
+emit_tree(struct sock_filter *pos, struct nr_range *ranges, int l, int r,
+          unsigned int action)
+{
+    int mid, left;
+
+    if (r - l == 1 && ranges[l].lo == ranges[l].hi) {
+        *pos++ = (struct sock_filter)
+            BPF_JUMP(BPF_JMP | BPF_JEQ | BPF_K, ranges[l].lo, 0, 1);
+        *pos++ = (struct sock_filter) BPF_STMT(BPF_RET | BPF_K, action);
+        *pos++ = (struct sock_filter) BPF_STMT(BPF_RET | BPF_K, SECCOMP_RET_ALLOW);
+        return pos;
+    } else if (r - l == 1) {
+        *pos++ = (struct sock_filter)
+            BPF_JUMP(BPF_JMP | BPF_JGE | BPF_K, ranges[l].lo, 0, 2);
+        *pos++ = (struct sock_filter)
+            BPF_JUMP(BPF_JMP | BPF_JGT | BPF_K, ranges[l].hi, 1, 0);
+        *pos++ = (struct sock_filter) BPF_STMT(BPF_RET | BPF_K, action);
+        *pos++ = (struct sock_filter) BPF_STMT(BPF_RET | BPF_K, SECCOMP_RET_ALLOW);
+        return pos;
+    }
+
+    /* left subtree below ranges[mid].lo, right subtree above */
+    mid = (l + r) / 2;
+    left = tree_size(ranges, l, mid);
+    if (left > 255) {
+        *pos++ = (struct sock_filter)
+            BPF_JUMP(BPF_JMP | BPF_JGE | BPF_K, ranges[mid].lo, 0, 1);
+        *pos++ = (struct sock_filter) BPF_STMT(BPF_JMP | BPF_JA | BPF_K, left);
+    } else {
+        *pos++ = (struct sock_filter)
+            BPF_JUMP(BPF_JMP | BPF_JGE | BPF_K, ranges[mid].lo, left, 0);
+    }
+    pos = emit_tree(pos, ranges, l, mid, action);
+    return emit_tree(pos, ranges, mid, r, action);
+}
+
+/* return 0 and the filter for the system call set in prog, -1 on error */
+static int
+build_filter(int num, int *syscalls, int flags, int f_errno, struct sock_fprog *prog)
 {
     unsigned int upper_nr_limit = 0xffffffff;
+    unsigned int action;
+    int nranges = 0, len;
 
     /* Assume that AUDIT_ARCH_X86_64 means the normal x86-64 ABI
        (in the x32 ABI, all system calls have bit 30 set in the
        'nr' field, meaning the numbers are >= X32_SYSCALL_BIT). */
     upper_nr_limit = X32_SYSCALL_BIT - 1;
 
-    struct sock_filter *filter = malloc(sizeof(struct sock_filter) * (6 + 2 * num));
+    if (ISSET(flags, DO_USERNOTIF)) {
+        action = SECCOMP_RET_USER_NOTIF;
+    } else if (ISSET(flags, DO_DISCOVER)) {
+        /* all system calls */
+        action = SECCOMP_RET_TRACE;
+    } else if (ISSET(flags, DO_PTRACE)) {
+        action = SECCOMP_RET_TRACE;
+    } else if (ISSET(flags, DO_ERRNO)) {
+        action = SECCOMP_RET_ERRNO | (f_errno & SECCOMP_RET_DATA);
+    } else if (ISSET(flags, DO_CRASH)) {
+        action = SECCOMP_RET_KILL_PROCESS;
+    } else {
+        printf("Error: build_filter(): "
+               "invalid flags (0x%x), this is a bug!\n", flags);
+        return -1;
+    }
+
+    for (int i = 0; i < num; i++)
+        debug("Registering rule (0x%x) for syscall %d.\n", action, syscalls[i]);
+
+    /* sorted, deduplicated ranges of contiguous system call numbers */
+    struct nr_range *ranges = malloc(sizeof(struct nr_range) * (num + 1));
+    qsort(syscalls, num, sizeof(int), compare_nr);
+    for (int i = 0; i < num; i++) {
+        if (nranges && (unsigned int) syscalls[i] <= ranges[nranges - 1].hi + 1) {
+            if ((unsigned int) syscalls[i] > ranges[nranges - 1].hi)
+                ranges[nranges - 1].hi = syscalls[i];
+            continue;
+        }
+        ranges[nranges].lo = ranges[nranges].hi = syscalls[i];
+        nranges++;
+    }
+
+    if (ISSET(flags, DO_DISCOVER))
+        len = 1;
+    else if (LINEAR_FILTER)
+        len = 2 * num + 1;
+    else if (nranges)
+        len = tree_size(ranges, 0, nranges);
+    else
+        len = 1;
+
+    struct sock_filter *filter = malloc(sizeof(struct sock_filter) * (6 + len));
     struct sock_filter filter_base[] = {
         /* [0] Load architecture from 'seccomp_data' buffer into
                accumulator. */
         BPF_STMT(BPF_LD | BPF_W | BPF_ABS,
                  (offsetof(struct seccomp_data, arch))),
 
-        /* [1] Jump to the end if architecture does not match X86_64. */
-        BPF_JUMP(BPF_JMP | BPF_JEQ | BPF_K, AUDIT_ARCH_X86_64, 0, 3 + 2 * num),
+        /* [1] Skip [2] if architecture matches X86_64. */
+        BPF_JUMP(BPF_JMP | BPF_JEQ | BPF_K, AUDIT_ARCH_X86_64, 1, 0),
 
-        /* [2] Load system call number from 'seccomp_data' buffer into
+        /* [2] Architecture mismatch: kill process. */
+        BPF_STMT(BPF_RET | BPF_K, SECCOMP_RET_KILL_PROCESS),
+
+        /* [3] Load system call number from 'seccomp_data' buffer into
                accumulator. */
         BPF_STMT(BPF_LD | BPF_W | BPF_ABS,
                  (offsetof(struct seccomp_data, nr))),
 
-        /* [3] Check ABI - only needed for x86-64 in deny-list use
+        /* [4] Check ABI - only needed for x86-64 in deny-list use
                cases.  Use BPF_JGT instead of checking against the bit
                mask to avoid having to reload the syscall number. */
-        BPF_JUMP(BPF_JMP | BPF_JGT | BPF_K, upper_nr_limit, 1 + 2 * num, 0),
+        BPF_JUMP(BPF_JMP | BPF_JGT | BPF_K, upper_nr_limit, 0, 1),
+
+        /* [5] x32 ABI: kill process. */
+        BPF_STMT(BPF_RET | BPF_K, SECCOMP_RET_KILL_PROCESS),
     };
     memcpy(filter, filter_base, sizeof(filter_base));
-    struct sock_filter *pos = (struct sock_filter *)
-	    (((uintptr_t) filter) + sizeof(filter_base));
-
-    for (int i = 0; i < num; i++) {
-        if (ISSET(flags, DO_PTRACE)) {
-            debug("Registering ptrace rule for syscall %d.\n", syscalls[i]);
-            struct sock_filter filter_sys_i[] = {
-                /* [4 + i] Jump forward 1 instruction if system call number
-                       does not match 'syscall_nr'. */
-                BPF_JUMP(BPF_JMP | BPF_JEQ | BPF_K, syscalls[i], 0, 1),
-
-                /* [5 + i] Matching architecture and system call: handle via
-		 * ptrace. */
-                BPF_STMT(BPF_RET | BPF_K, SECCOMP_RET_TRACE),
-            };
-            memcpy(pos, filter_sys_i, sizeof(filter_sys_i));
-            pos = (struct sock_filter *) (((uintptr_t) pos) + sizeof(filter_sys_i));
-	} else if (ISSET(flags, DO_ERRNO)) {
-            debug("Registering errno %d rule for syscall %d.\n", f_errno, syscalls[i]);
-            struct sock_filter filter_sys_i[] = {
-                /* [4 + i] Jump forward 1 instruction if system call number
-                       does not match 'syscall_nr'. */
-                BPF_JUMP(BPF_JMP | BPF_JEQ | BPF_K, syscalls[i], 0, 1),
-
-                /* [5 + i] Matching architecture and system call: don't execute
-                   the system call, and return 'f_errno' in 'errno'. */
-                BPF_STMT(BPF_RET | BPF_K,
-                         SECCOMP_RET_ERRNO | (f_errno & SECCOMP_RET_DATA)),
-            };
-            memcpy(pos, filter_sys_i, sizeof(filter_sys_i));
-            pos = (struct sock_filter *) (((uintptr_t) pos) + sizeof(filter_sys_i));
-        } else if (ISSET(flags, DO_CRASH)) {
-            debug("Registering crash rule for syscall %d.\n", syscalls[i]);
-            struct sock_filter filter_sys_i[] = {
-                /* [4 + i] Jump forward 1 instruction if system call number
-                       does not match 'syscall_nr'. */
-                BPF_JUMP(BPF_JMP | BPF_JEQ | BPF_K, syscalls[i], 0, 1),
-
-                /* [5 + i] Matching architecture and system call: don't execute
-                   the system call, and crash. */
-                BPF_STMT(BPF_RET | BPF_K, SECCOMP_RET_KILL_PROCESS),
-            };
-            memcpy(pos, filter_sys_i, sizeof(filter_sys_i));
-            pos = (struct sock_filter *) (((uintptr_t) pos) + sizeof(filter_sys_i));
-        } else {
-		printf("Error: install_filter(): "
-                       "invalid flags (0x%x), this is a bug!\n", flags);
-                return 1;
+    struct sock_filter *pos = filter + ARRAY_SIZE(filter_base);
+
+    if (ISSET(flags, DO_DISCOVER)) {
+        *pos++ = (struct sock_filter) BPF_STMT(BPF_RET | BPF_K, action);
+    } else if (LINEAR_FILTER) {
+        for (int i = 0; i < num; i++) {
+            /* [6 + 2 * i] Jump forward 1 instruction if system call number
+                   does not match 'syscall_nr', [7 + 2 * i] or handle it. */
+            *pos++ = (struct sock_filter)
+                BPF_JUMP(BPF_JMP | BPF_JEQ | BPF_K, syscalls[i], 0, 1);
+            *pos++ = (struct sock_filter) BPF_STMT(BPF_RET | BPF_K, action);
         }
+        /* [6 + 2 * num] Allow other system calls. */
+        *pos++ = (struct sock_filter) BPF_STMT(BPF_RET | BPF_K, SECCOMP_RET_ALLOW);
+    } else if (nranges) {
+        pos = emit_tree(pos, ranges, 0, nranges, action);
+    } else {
+        *pos++ = (struct sock_filter) BPF_STMT(BPF_RET | BPF_K, SECCOMP_RET_ALLOW);
     }
 
-    struct sock_filter filter_end[] = {
-        /* [4 + 2 * num] Destination of system call number mismatch: allow other
-               system calls. */
+    prog->len = 6 + len;
+    prog->filter = filter;
+    free(ranges);
+
+    debug("Filter: %d instructions, %d ranges.\n", prog->len, nranges);
+    return 0;
+}
+
+/* partial stubbing (-p) without ptrace: compare the argument in the filter,
+ * so that only the matching calls ever leave the kernel path */
+static int
+build_arg_filter(int sys, int argn, unsigned long argv, int flags, int f_errno,
+                 struct sock_fprog *prog)
+{
+    unsigned int upper_nr_limit = X32_SYSCALL_BIT - 1;
+    unsigned int action;
+
+    if (ISSET(flags, DO_USERNOTIF)) {
+        action = SECCOMP_RET_USER_NOTIF;
+    } else if (ISSET(flags, DO_PTRACE)) {
+        action = SECCOMP_RET_TRACE;
+    } else if (ISSET(flags, DO_ERRNO)) {
+        debug("Registering errno %d rule for syscall %d, arg %d = 0x%lx.\n",
+              f_errno, sys, argn, argv);
+        action = SECCOMP_RET_ERRNO | (f_errno & SECCOMP_RET_DATA);
+    } else if (ISSET(flags, DO_CRASH)) {
+        debug("Registering crash rule for syscall %d, arg %d = 0x%lx.\n",
+              sys, argn, argv);
+        action = SECCOMP_RET_KILL_PROCESS;
+    } else {
+        printf("Error: build_arg_filter(): "
+               "invalid flags (0x%x), this is a bug!\n", flags);
+        return -1;
+    }
+
+    struct sock_filter filter[] = {
+        /* [0] Load architecture. */
+        BPF_STMT(BPF_LD | BPF_W | BPF_ABS,
+                 (offsetof(struct seccomp_data, arch))),
+
+        /* [1] Jump to the end if architecture does not match X86_64. */
+        BPF_JUMP(BPF_JMP | BPF_JEQ | BPF_K, AUDIT_ARCH_X86_64, 0, 9),
+
+        /* [2] Load system call number. */
+        BPF_STMT(BPF_LD | BPF_W | BPF_ABS,
+                 (offsetof(struct seccomp_data, nr))),
+
+        /* [3] Check ABI (see install_filter()). */
+        BPF_JUMP(BPF_JMP | BPF_JGT | BPF_K, upper_nr_limit, 7, 0),
+
+        /* [4] Allow other system calls. */
+        BPF_JUMP(BPF_JMP | BPF_JEQ | BPF_K, sys, 0, 5),
+
+        /* [5] Load the lower 32 bits of the argument (x86-64 is little
+               endian) and [6] allow the call if they differ. */
+        BPF_STMT(BPF_LD | BPF_W | BPF_ABS,
+                 (offsetof(struct seccomp_data, args) + 8 * argn)),
+        BPF_JUMP(BPF_JMP | BPF_JEQ | BPF_K, (uint32_t) argv, 0, 3),
+
+        /* [7] Same for the upper 32 bits, [8]. */
+        BPF_STMT(BPF_LD | BPF_W | BPF_ABS,
+                 (offsetof(struct seccomp_data, args) + 8 * argn + 4)),
+        BPF_JUMP(BPF_JMP | BPF_JEQ | BPF_K, (uint32_t) (argv >> 32), 0, 1),
+
+        /* [9] Matching system call and argument: crash or return errno. */
+        BPF_STMT(BPF_RET | BPF_K, action),
+
+        /* [10] Allow other system calls. */
         BPF_STMT(BPF_RET | BPF_K, SECCOMP_RET_ALLOW),
 
-        /* [5 + 2 * num] Destination of architecture mismatch: kill process. */
+        /* [11] Destination of architecture mismatch: kill process. */
         BPF_STMT(BPF_RET | BPF_K, SECCOMP_RET_KILL_PROCESS),
     };
-    memcpy(pos, filter_end, sizeof(filter_end));
 
-    struct sock_fprog prog = {
-        .len = 6 + 2 * num,
-        .filter = filter,
-    };
+    prog->len = ARRAY_SIZE(filter);
+    prog->filter = malloc(sizeof(filter));
+    memcpy(prog->filter, filter, sizeof(filter));
+    return 0;
+}
 
-    if (syscall(SYS_seccomp, SECCOMP_SET_MODE_FILTER, 0, &prog)) {
+/* return the user notification listener fd with DO_USERNOTIF, 0 otherwise,
+ * -1 on error */
+static int
+install_filter(struct sock_fprog *prog, int flags)
+{
+    int ret = syscall(SYS_seccomp, SECCOMP_SET_MODE_FILTER,
+                      ISSET(flags, DO_USERNOTIF) ?
+                          SECCOMP_FILTER_FLAG_NEW_LISTENER : 0, prog);
+    if (ret < 0) {
         perror("seccomp");
-        return 1;
+        return -1;
     }
 
-    return 0;
+    return ret;
 }
 
 /* fetch system call arguments in the registers */
@@ -230,8 +497,7 @@ int ptracer_check_path(unsigned long pid) {
     /* readlink doesn't append null character */
     binary_path[nbytes] = 0;
 
-    char *ret = strstr(EXECUTABLE_PATH, binary_path);
-    if (ret != NULL) {
+    if (strcmp(EXECUTABLE_PATH, binary_path) != 0) {
         debug("Found different binary: %s\n", binary_path);
         return -1;
     }
@@ -239,17 +505,161 @@ int ptracer_check_path(unsigned long pid) {
     return 0;
 }
 
+static struct proc_state *proc_lookup(pid_t pid)
+{
+    for (int i = 0; i < NPROCS; i++)
+        if (PROCS[i].pid == pid)
+            return &PROCS[i];
+
+    /* grow by powers of two */
+    if ((NPROCS & (NPROCS - 1)) == 0)
+        PROCS = realloc(PROCS, sizeof(struct proc_state) *
+                               (NPROCS ? 2 * NPROCS : 1));
+    PROCS[NPROCS].pid = pid;
+    PROCS[NPROCS].exe = -1;
+    PROCS[NPROCS].filtered = 0;
+    return &PROCS[NPROCS++];
+}
+
+static void proc_forget(pid_t pid)
+{
+    for (int i = 0; i < NPROCS; i++) {
+        if (PROCS[i].pid == pid) {
+            PROCS[i] = PROCS[--NPROCS];
+            return;
+        }
+    }
+}
+
+/* ptracer_check_path(), but readlink only once per process and exec */
+int ptracer_check_path_cached(pid_t pid)
+{
+    struct proc_state *proc = proc_lookup(pid);
+
+    if (proc->exe < 0)
+        proc->exe = (ptracer_check_path(pid) != 0);
+
+    return proc->exe ? -1 : 0;
+}
+
+/* write len bytes (a multiple of sizeof(long)) at addr in the tracee */
+static int ptrace_poke_data(pid_t pid, unsigned long addr, void *data, size_t len)
+{
+    for (size_t i = 0; i < len; i += sizeof(long)) {
+        if (ptrace(PTRACE_POKEDATA, pid, addr + i, *(long *) ((char *) data + i))) {
+            perror("ptrace(PTRACE_POKEDATA, _)");
+            return -1;
+        }
+    }
+    return 0;
+}
+
+/* make the tracee, stopped right after an exec, install INJECT_PROG: copy
+ * the filter below its stack pointer (unused yet), and single-step a
+ * seccomp() system call instruction written at its entry point */
+static int inject_filter(pid_t pid)
+{
+    struct user_regs_struct regs, saved;
+    size_t filter_size = INJECT_PROG.len * sizeof(struct sock_filter);
+    unsigned long filter_addr, prog_addr, text;
+    struct sock_fprog remote_prog;
+    int status;
+
+    if (ptrace(PTRACE_GETREGS, pid, 0, &saved)) {
+        perror("ptrace(PTRACE_GETREGS, _)");
+        return -1;
+    }
+
+    /* keep clear of the red zone */
+    prog_addr = (saved.rsp - 128 - sizeof(struct sock_fprog)) & ~0xfUL;
+    filter_addr = (prog_addr - filter_size) & ~0xfUL;
+    memset(&remote_prog, 0, sizeof(remote_prog));
+    remote_prog.len = INJECT_PROG.len;
+    remote_prog.filter = (struct sock_filter *) filter_addr;
+    if (ptrace_poke_data(pid, filter_addr, INJECT_PROG.filter, filter_size) ||
+        ptrace_poke_data(pid, prog_addr, &remote_prog, sizeof(remote_prog)))
+        return -1;
+
+    errno = 0;
+    text = ptrace(PTRACE_PEEKTEXT, pid, saved.rip, 0);
+    if (errno) {
+        perror("ptrace(PTRACE_PEEKTEXT, _)");
+        return -1;
+    }
+    /* 0f 05: syscall */
+    if (ptrace(PTRACE_POKETEXT, pid, saved.rip, (text & ~0xffffUL) | 0x050f)) {
+        perror("ptrace(PTRACE_POKETEXT, _)");
+        return -1;
+    }
+
+    /* leaving the exec stop is reported as a first step already, after
+     * the return value of execve is set (see ptrace_report_syscall_exit()):
+     * set the registers again until we actually step over our instruction */
+    regs = saved;
+    for (int steps = 0; regs.rip != saved.rip + 2; steps++) {
+        regs = saved;
+        regs.orig_rax = -1;
+        regs.rax = SYS_seccomp;
+        regs.rdi = SECCOMP_SET_MODE_FILTER;
+        regs.rsi = 0;
+        regs.rdx = prog_addr;
+        ptrace(PTRACE_SETREGS, pid, 0, &regs);
+        ptrace(PTRACE_SINGLESTEP, pid, 0, 0);
+        if (steps == 2 || waitpid(pid, &status, __WALL) == -1 ||
+            !WIFSTOPPED(status) || WSTOPSIG(status) != SIGTRAP) {
+            error("%d: could not single-step the filter installation.\n", pid);
+            return -1;
+        }
+        ptrace(PTRACE_GETREGS, pid, 0, &regs);
+    }
+
+    ptrace(PTRACE_POKETEXT, pid, saved.rip, text);
+    ptrace(PTRACE_SETREGS, pid, 0, &saved);
+
+    if (regs.rax != 0) {
+        error("%d: seccomp() failed in the tracee (%lld).\n", pid, (long long) regs.rax);
+        return -1;
+    }
+
+    debug("%d: filter injected.\n", pid);
+    return 0;
+}
+
+/* a traced process exec-ed: forget what we knew, and give it the filter if
+ * it now runs the target binary */
+static int ptracer_handle_exec(pid_t pid, int flags)
+{
+    struct proc_state *proc = proc_lookup(pid);
+
+    proc->exe = -1;
+    if (!ISSET(flags, DO_INJECT) || proc->filtered ||
+        ptracer_check_path_cached(pid) != 0)
+        return 0;
+
+    if (inject_filter(pid))
+        return -1;
+    proc_lookup(pid)->filtered = 1;
+    return 0;
+}
+
+/* read strings word by word with PTRACE_PEEKDATA rather than with
+ * process_vm_readv (kernels without CONFIG_CROSS_MEMORY_ATTACH, or -P) */
+static int PEEKDATA_STRINGS = 0;
+
 /* NOTE: buffer *must* be able to contain PATH_MAX bytes */
-int ptrace_get_string_from_tracee(unsigned long long addr, pid_t child, void *buffer)
+static int ptrace_peek_string_from_tracee(unsigned long long addr, pid_t child, void *buffer)
 {
-    long *buffer_int = (long*) buffer;
+    /* read aligned words, which never cross a page boundary */
+    size_t offset = addr % sizeof(long);
+    long buffer_int[PATH_MAX / sizeof(long) + 1];
     unsigned long tmp;
     size_t byte = 0;
-    size_t data;
 
     memset(buffer, 0, PATH_MAX);
+    memset(buffer_int, 0, sizeof(buffer_int));
+    addr -= offset;
 
-    while (byte < PATH_MAX) {
+    while (byte < sizeof(buffer_int)) {
         /* from the ptrace manpage:
          *   Since the value returned by a successful PTRACE_PEEK*
          *   request may be -1, the caller must clear errno before
@@ -272,9 +682,10 @@ int ptrace_get_string_from_tracee(unsigned long long addr, pid_t child, void *bu
              if (byte != 0) {
                  break;
              } else {
-                 error("tracee passed an invalid path pointer (%p) to the "
-                       "kernel - bug somewhere\n", (void *) addr);
-                 exit(1);
+                 /* the system call will fail with EFAULT */
+                 debug("tracee passed an invalid path pointer (%p) to the "
+                       "kernel\n", (void *) addr);
+                 return -1;
              }
         } else if (errno) {
             perror("ptrace(PTRACE_PEEKDATA, _)");
@@ -283,25 +694,157 @@ int ptrace_get_string_from_tracee(unsigned long long addr, pid_t child, void *bu
 
         buffer_int[byte / sizeof(long)] = tmp;
 
+        /* stop at the end of the string */
+        if (memchr((char *) &tmp + (byte ? 0 : offset), 0,
+                   sizeof(long) - (byte ? 0 : offset)) != NULL)
+            break;
+
         byte += sizeof(long);
     }
 
+    memcpy(buffer, (char *) buffer_int + offset, PATH_MAX - 1);
     return 0;
 }
 
-int ptracer_loop(long sys, int argn, long argv, char *path, int flags, int f_errno)
+/* NOTE: buffer *must* be able to contain PATH_MAX bytes; read the string in
+ * one process_vm_readv, with one remote iovec per page: the transfer stops
+ * at the first unmapped page instead of failing, as the string may end
+ * right before it */
+int ptrace_get_string_from_tracee(unsigned long long addr, pid_t child, void *buffer)
+{
+    struct iovec local, remote[PATH_MAX / 4096 + 2];
+    unsigned long page = 4096;
+    size_t byte = 0;
+    ssize_t nbytes;
+    int n = 0;
+
+    if (PEEKDATA_STRINGS)
+        return ptrace_peek_string_from_tracee(addr, child, buffer);
+
+    memset(buffer, 0, PATH_MAX);
+
+    while (byte < PATH_MAX - 1) {
+        size_t chunk = page - ((addr + byte) % page);
+        if (chunk > PATH_MAX - 1 - byte)
+            chunk = PATH_MAX - 1 - byte;
+        remote[n].iov_base = (void *) (uintptr_t) (addr + byte);
+        remote[n].iov_len = chunk;
+        n++;
+        byte += chunk;
+    }
+    local.iov_base = buffer;
+    local.iov_len = byte;
+
+    nbytes = process_vm_readv(child, &local, 1, remote, n, 0);
+    if (nbytes == -1 && errno == ENOSYS) {
+        debug("process_vm_readv unsupported, falling back to PTRACE_PEEKDATA.\n");
+        PEEKDATA_STRINGS = 1;
+        return ptrace_peek_string_from_tracee(addr, child, buffer);
+    } else if (nbytes <= 0) {
+        /* the system call will fail with EFAULT */
+        debug("tracee passed an invalid path pointer (%p) to the "
+              "kernel\n", (void *) addr);
+        return -1;
+    }
+
+    return 0;
+}
+
+/* JSON string, as far as paths are concerned */
+static void discovery_print_string(const char *str)
+{
+    fputc('"', DISCOVERY_OUT);
+    for (const unsigned char *c = (const unsigned char *) str; *c; c++) {
+        if (*c == '"' || *c == '\\')
+            fprintf(DISCOVERY_OUT, "\\%c", *c);
+        else if (*c < 0x20)
+            fprintf(DISCOVERY_OUT, "\\u%04x", *c);
+        else
+            fputc(*c, DISCOVERY_OUT);
+    }
+    fputc('"', DISCOVERY_OUT);
+}
+
+/* record system call nr and the watched arguments (-a, -s) of pid */
+static void discovery_record(pid_t pid, long nr, struct user_regs_struct regs)
+{
+    int new = 0;
+
+    if (nr < 0 || nr >= MAX_SEEN_NR || !SEEN_NR[nr]) {
+        if (nr >= 0 && nr < MAX_SEEN_NR)
+            SEEN_NR[nr] = 1;
+        fprintf(DISCOVERY_OUT, "{\"nr\": %ld}\n", nr);
+        new = 1;
+    }
+
+    for (int i = 0; i < NWATCHED; i++) {
+        char path_buffer[PATH_MAX];
+        unsigned long val;
+        int j;
+
+        if (WATCHED[i].nr != nr)
+            continue;
+
+        val = ptrace_get_syscall_args(WATCHED[i].pos, regs);
+        if (WATCHED[i].is_path &&
+            ptrace_get_string_from_tracee(val, pid, &path_buffer))
+            continue;
+        path_buffer[PATH_MAX - 1] = 0;
+
+        for (j = 0; j < NSEEN_ARGS; j++) {
+            if (SEEN_ARGS[j].nr != nr || SEEN_ARGS[j].pos != WATCHED[i].pos)
+                continue;
+            if (WATCHED[i].is_path ? !strcmp(SEEN_ARGS[j].path, path_buffer)
+                                   : SEEN_ARGS[j].val == val)
+                break;
+        }
+        if (j < NSEEN_ARGS)
+            continue;
+
+        /* grow by powers of two */
+        if ((NSEEN_ARGS & (NSEEN_ARGS - 1)) == 0)
+            SEEN_ARGS = realloc(SEEN_ARGS, sizeof(struct seen_arg) *
+                                           (NSEEN_ARGS ? 2 * NSEEN_ARGS : 1));
+        SEEN_ARGS[NSEEN_ARGS].nr = nr;
+        SEEN_ARGS[NSEEN_ARGS].pos = WATCHED[i].pos;
+        SEEN_ARGS[NSEEN_ARGS].val = val;
+        SEEN_ARGS[NSEEN_ARGS].path = WATCHED[i].is_path ? strdup(path_buffer) : NULL;
+        NSEEN_ARGS++;
+
+        fprintf(DISCOVERY_OUT, "{\"nr\": %ld, \"arg\": %d, ", nr, WATCHED[i].pos);
+        if (WATCHED[i].is_path) {
+            fprintf(DISCOVERY_OUT, "\"path\": ");
+            discovery_print_string(path_buffer);
+            fprintf(DISCOVERY_OUT, "}\n");
+        } else {
+            fprintf(DISCOVERY_OUT, "\"val\": %lu}\n", val);
+        }
+        new = 1;
+    }
+
+    if (new)
+        fflush(DISCOVERY_OUT);
+}
+
+/* return the exit code for seccomp-run: that of the child (root), or
+ * 128 + signal number if it was killed (as a shell would), -1 on error */
+int ptracer_loop(pid_t root, long sys, int argn, long argv, char *path, int flags, int f_errno)
 {
     struct user_regs_struct regs;
     long syscall;
     int status = 0;
+    int exit_code = 0;
     siginfo_t siginfo;
     unsigned long pid, child_pid;
     int number_of_children = 1; /* keep track of the family */
 
-    if (!ISSET(flags, DO_PTRACE) /* ptrace must be enabled */ ||
-       /* either partial/path stubbing or check patch must be enabled */
+    if (ISSET(flags, DO_DISCOVER)) {
+        /* nothing to stub */
+    } else if (!ISSET(flags, DO_PTRACE) /* ptrace must be enabled */ ||
+       /* either partial/path stubbing, check patch or counting must be
+        * enabled */
        (!ISSET(flags, DO_PARTIALSTUB) && !ISSET(flags, DO_CHECKPATH)
-        && !ISSET(flags, DO_PATHSTUB)) ||
+        && !ISSET(flags, DO_PATHSTUB) && !ISSET(flags, DO_COUNT)) ||
        /* either crash or errno must be enabled */
        (!ISSET(flags, DO_CRASH) && !ISSET(flags, DO_ERRNO)) ||
        /* but not both of them */
@@ -318,21 +861,31 @@ int ptracer_loop(long sys, int argn, long argv, char *path, int flags, int f_err
             pid = waitpid(-1, &status, __WALL);
 
 	    if (pid == -1) {
+                if (errno == ECHILD)
+                    return exit_code;
                 perror("waitpid");
                 return -1;
             }
 
 	    /* exit if our child died (sad, but happens) */
-            if (WIFEXITED(status)) {
+            if (WIFEXITED(status) || WIFSIGNALED(status)) {
                 number_of_children -= 1;
+                proc_forget(pid);
                 debug("%lu: died, %d children remaining.\n", pid, number_of_children);
+
+                if (pid == root)
+                    exit_code = WIFEXITED(status) ? WEXITSTATUS(status)
+                                                  : 128 + WTERMSIG(status);
             }
 
             if (number_of_children == 0) {
                 debug("actually, we're alone now. Exiting.\n");
-                return 0;
+                return exit_code;
             }
 
+            if (WIFEXITED(status) || WIFSIGNALED(status))
+                continue;
+
             if (status >> 8 == (SIGTRAP | (PTRACE_EVENT_SECCOMP << 8)))
                 break;
 
@@ -343,12 +896,23 @@ int ptracer_loop(long sys, int argn, long argv, char *path, int flags, int f_err
                 ptrace(PTRACE_GETEVENTMSG, pid, 0, &child_pid);
                 debug("%lu: new child detected (%lu). Tracing it as well.\n",
                       pid, child_pid);
+                /* same binary, same filter */
+                struct proc_state parent = *proc_lookup(pid);
+                proc_lookup(child_pid)->exe = parent.exe;
+                proc_lookup(child_pid)->filtered = parent.filtered;
 		/* no need to reset child ptrace flags via PTRACE_SETOPTIONS
 		 * as these are inherited automatically */
                 ptrace(PTRACE_CONT, pid, 0, 0);
                 continue;
             }
 
+            if (status >> 8 == (SIGTRAP | (PTRACE_EVENT_EXEC << 8))) {
+                if (ptracer_handle_exec(pid, flags))
+                    return -1;
+                ptrace(PTRACE_CONT, pid, 0, 0);
+                continue;
+            }
+
             /* got another signal, pass through */
             ptrace(PTRACE_GETSIGINFO, pid, 0, &siginfo);
             /* this log entry is not always useful */
@@ -360,6 +924,13 @@ int ptracer_loop(long sys, int argn, long argv, char *path, int flags, int f_err
         syscall = regs.orig_rax;
 
         debug("%lu: got a seccomp event for syscall %ld.\n", pid, syscall);
+        if (ISSET(flags, DO_DISCOVER)) {
+            if (!ISSET(flags, DO_CHECKPATH) || ptracer_check_path_cached(pid) == 0)
+                discovery_record(pid, syscall, regs);
+            ptrace(PTRACE_CONT, pid, 0, 0);
+            continue;
+        }
+
 	if (ISSET(flags, DO_PARTIALSTUB) || ISSET(flags, DO_PATHSTUB)) {
             /* check system call number */
             if (syscall != sys) {
@@ -390,7 +961,7 @@ int ptracer_loop(long sys, int argn, long argv, char *path, int flags, int f_err
             }
         }
 
-        if (ISSET(flags, DO_CHECKPATH) && ptracer_check_path(pid) != 0) {
+        if (ISSET(flags, DO_CHECKPATH) && ptracer_check_path_cached(pid) != 0) {
 	    /* path is different, this is not a binary we want to mess with */
             debug("%lu: disabling seccomp for the child (different binary)\n", pid)
             //ptrace(PTRACE_SETOPTIONS, pid, 0, PTRACE_O_SUSPEND_SECCOMP);
@@ -400,10 +971,12 @@ int ptracer_loop(long sys, int argn, long argv, char *path, int flags, int f_err
 
 	/* right syscall *and* arguments, kill or return errno */
         debug("\thandling this system call.\n")
+        count_hit(syscall);
         if (ISSET(flags, DO_CRASH)) {
                 debug("\tcrash mode, killing the child %lu.\n", pid);
-		/* this will kill the child because of PTRACE_O_EXITKILL */
-                return 0;
+		/* this will kill the child because of PTRACE_O_EXITKILL;
+		 * exit as if seccomp had killed it */
+                return 128 + SIGSYS;
         } else /* ISSET(flags, DO_ERRNO) */ {
 		/* change the system call number to an invalid one,
 		 * then capture the result and change it to requested errno */
@@ -411,7 +984,7 @@ int ptracer_loop(long sys, int argn, long argv, char *path, int flags, int f_err
                 ptrace(PTRACE_SETREGS, pid, 0, &regs);
                 ptrace(PTRACE_SYSCALL, pid, 0, 0); /* run, stop on syscall exit */
                 waitpid(pid, NULL, __WALL);
-                regs.rax = f_errno;
+                regs.rax = -f_errno;
                 ptrace(PTRACE_SETREGS, pid, 0, &regs); /* set errno, finish */
                 ptrace(PTRACE_CONT, pid, 0, 0);
 	}
@@ -420,6 +993,244 @@ int ptracer_loop(long sys, int argn, long argv, char *path, int flags, int f_err
     return 0;
 }
 
+/* NOTE: buffer *must* be able to contain PATH_MAX bytes; read the string
+ * through /proc/<pid>/mem without stopping the caller, page by page as the
+ * string may end right before an unmapped page */
+int notif_get_string_from_caller(unsigned long long addr, pid_t pid, void *buffer)
+{
+    char mem_path[64];
+    size_t byte = 0;
+    ssize_t nbytes;
+    int fd;
+
+    memset(buffer, 0, PATH_MAX);
+
+    sprintf(mem_path, "/proc/%d/mem", pid);
+    fd = open(mem_path, O_RDONLY | O_CLOEXEC);
+    if (fd == -1) {
+        perror("open(/proc/<pid>/mem)");
+        return -1;
+    }
+
+    while (byte < PATH_MAX - 1) {
+        size_t chunk = 4096 - ((addr + byte) % 4096);
+        if (chunk > PATH_MAX - 1 - byte)
+            chunk = PATH_MAX - 1 - byte;
+
+        nbytes = pread(fd, (char *) buffer + byte, chunk, addr + byte);
+        if (nbytes <= 0) {
+            if (byte != 0)
+                break;
+            error("caller passed an invalid path pointer (%p) to the "
+                  "kernel - bug somewhere\n", (void *) addr);
+            close(fd);
+            return -1;
+        }
+
+        if (memchr((char *) buffer + byte, 0, nbytes) != NULL)
+            break;
+        byte += nbytes;
+    }
+
+    close(fd);
+    return 0;
+}
+
+/* same as ptracer_loop, but the filter returns SECCOMP_RET_USER_NOTIF and we
+ * decide from the notifications, without stopping the callers: system calls
+ * that we do not stub are resumed with SECCOMP_USER_NOTIF_FLAG_CONTINUE */
+int notif_loop(pid_t root, int listener, long sys, int argn, long argv,
+               char *path, int flags, int f_errno)
+{
+    struct seccomp_notif_sizes sizes;
+    struct seccomp_notif *req;
+    struct seccomp_notif_resp *resp;
+    struct pollfd fds[2];
+    int status = 0;
+    int exit_code = 0;
+    int nfds = 2;
+
+    if (!ISSET(flags, DO_USERNOTIF) ||
+       (!ISSET(flags, DO_PARTIALSTUB) && !ISSET(flags, DO_CHECKPATH)
+        && !ISSET(flags, DO_PATHSTUB) && !ISSET(flags, DO_COUNT)) ||
+       (!ISSET(flags, DO_CRASH) && !ISSET(flags, DO_ERRNO)) ||
+       ( ISSET(flags, DO_CRASH) &&  ISSET(flags, DO_ERRNO))) {
+        error ("BUG: notif_loop called with "
+               "invalid flags (0x%x)\n", flags);
+        return -1;
+    }
+
+    if (syscall(SYS_seccomp, SECCOMP_GET_NOTIF_SIZES, 0, &sizes)) {
+        perror("seccomp(SECCOMP_GET_NOTIF_SIZES)");
+        return -1;
+    }
+    req = malloc(sizes.seccomp_notif);
+    resp = malloc(sizes.seccomp_notif_resp);
+
+    /* the listener hangs up once all users of the filter are gone, which
+     * includes the root only after we reaped it: watch it with a pidfd */
+    fds[0].fd = listener;
+    fds[0].events = POLLIN;
+    fds[1].fd = syscall(SYS_pidfd_open, root, 0);
+    fds[1].events = POLLIN;
+    if (fds[1].fd == -1) {
+        perror("pidfd_open");
+        return -1;
+    }
+
+    while (1) {
+        if (poll(fds, nfds, -1) == -1) {
+            if (errno == EINTR)
+                continue;
+            perror("poll");
+            return -1;
+        }
+
+        if (nfds == 2 && fds[1].revents) {
+            waitpid(root, &status, 0);
+            exit_code = WIFEXITED(status) ? WEXITSTATUS(status)
+                                          : 128 + WTERMSIG(status);
+            debug("%d: died, waiting for the rest of the family.\n", root);
+            close(fds[1].fd);
+            nfds = 1;
+        }
+
+        if (fds[0].revents & POLLIN) {
+            memset(req, 0, sizes.seccomp_notif);
+            if (ioctl(listener, SECCOMP_IOCTL_NOTIF_RECV, req)) {
+                /* the caller is gone already */
+                if (errno == EINTR || errno == ENOENT)
+                    continue;
+                perror("ioctl(SECCOMP_IOCTL_NOTIF_RECV)");
+                return -1;
+            }
+
+            memset(resp, 0, sizes.seccomp_notif_resp);
+            resp->id = req->id;
+            resp->flags = SECCOMP_USER_NOTIF_FLAG_CONTINUE;
+
+            debug("%d: got a notification for syscall %d.\n", req->pid, req->data.nr);
+            if (ISSET(flags, DO_PARTIALSTUB) || ISSET(flags, DO_PATHSTUB)) {
+                if (req->data.nr != sys) {
+                    debug("\tnot the syscall (listening for %ld).\n", sys);
+                    goto send;
+                }
+
+                if (ISSET(flags, DO_PARTIALSTUB) && (long) req->data.args[argn] != argv) {
+                    debug("\tnot the right argument (0x%llx vs 0x%lx).\n",
+                          req->data.args[argn], argv);
+                    goto send;
+                } else if (ISSET(flags, DO_PATHSTUB)) {
+                    char path_buffer[PATH_MAX];
+
+                    if (notif_get_string_from_caller(req->data.args[argn],
+                                                     req->pid, &path_buffer))
+                        goto send;
+
+                    /* the pid may have been recycled while we were reading */
+                    if (ioctl(listener, SECCOMP_IOCTL_NOTIF_ID_VALID, &req->id)) {
+                        debug("\tcaller gone while reading its memory.\n");
+                        continue;
+                    }
+
+                    if (strcmp(path_buffer, path) != 0) {
+                        debug("\tnot the right argument ('%s' v.s. '%s').\n",
+                               path_buffer, path);
+                        goto send;
+                    }
+                }
+            }
+
+            if (ISSET(flags, DO_CHECKPATH) && ptracer_check_path(req->pid) != 0) {
+                debug("%d: different binary, letting the syscall through\n", req->pid)
+                goto send;
+            }
+
+            debug("\thandling this system call.\n")
+            count_hit(req->data.nr);
+            if (ISSET(flags, DO_CRASH)) {
+                debug("\tcrash mode, killing %d.\n", req->pid);
+                /* as SECCOMP_RET_KILL_PROCESS would, and stop the root too
+                 * as ptrace's PTRACE_O_EXITKILL does */
+                kill(req->pid, SIGKILL);
+                kill(root, SIGKILL);
+                return 128 + SIGSYS;
+            }
+            resp->flags = 0;
+            resp->error = -f_errno;
+            resp->val = 0;
+
+send:
+            if (ioctl(listener, SECCOMP_IOCTL_NOTIF_SEND, resp) && errno != ENOENT) {
+                perror("ioctl(SECCOMP_IOCTL_NOTIF_SEND)");
+                return -1;
+            }
+        } else if (fds[0].revents & (POLLHUP | POLLERR)) {
+            if (nfds == 2) {
+                /* the root is a zombie but its pidfd did not fire yet */
+                continue;
+            }
+            debug("actually, we're alone now. Exiting.\n");
+            return exit_code;
+        }
+    }
+
+    return 0;
+}
+
+/* whether the set contains a system call that the child needs between
+ * installing the filter and exec'ing the program (see main()) */
+static int notif_deadlocks(int num, int *syscalls)
+{
+    for (int i = 0; i < num; i++)
+        if (syscalls[i] == SYS_sendmsg || syscalls[i] == SYS_execve)
+            return 1;
+    return 0;
+}
+
+/* pass the listener fd from the child to the parent */
+static int send_fd(int sock, int fd)
+{
+    char buf[CMSG_SPACE(sizeof(int))] = {0};
+    char dummy = 0;
+    struct iovec iov = { .iov_base = &dummy, .iov_len = 1 };
+    struct msghdr msg = {
+        .msg_iov = &iov, .msg_iovlen = 1,
+        .msg_control = buf, .msg_controllen = sizeof(buf),
+    };
+    struct cmsghdr *cmsg = CMSG_FIRSTHDR(&msg);
+
+    cmsg->cmsg_level = SOL_SOCKET;
+    cmsg->cmsg_type = SCM_RIGHTS;
+    cmsg->cmsg_len = CMSG_LEN(sizeof(int));
+    memcpy(CMSG_DATA(cmsg), &fd, sizeof(int));
+
+    return sendmsg(sock, &msg, 0) == 1 ? 0 : -1;
+}
+
+static int recv_fd(int sock)
+{
+    char buf[CMSG_SPACE(sizeof(int))] = {0};
+    char dummy;
+    int fd;
+    struct iovec iov = { .iov_base = &dummy, .iov_len = 1 };
+    struct msghdr msg = {
+        .msg_iov = &iov, .msg_iovlen = 1,
+        .msg_control = buf, .msg_controllen = sizeof(buf),
+    };
+    struct cmsghdr *cmsg;
+
+    if (recvmsg(sock, &msg, MSG_CMSG_CLOEXEC) != 1)
+        return -1;
+
+    cmsg = CMSG_FIRSTHDR(&msg);
+    if (cmsg == NULL || cmsg->cmsg_type != SCM_RIGHTS)
+        return -1;
+
+    memcpy(&fd, CMSG_DATA(cmsg), sizeof(int));
+    return fd;
+}
+
 void
 usage(char *name)
 {
@@ -431,14 +1242,31 @@ usage(char *name)
             "         -p <parameter position> <parameter value>\n"
             "         -t <path pointer position> <path value after deref>\n"
             "         NOTE: both only works with one syscall, i.e., -n 1 *\n"
-            "         NOTE: uses ptrace, enabling this makes your "
-            "program *much* slower.\n"
+            "         NOTE: -t (and -p with -y) uses ptrace, enabling this "
+            "makes your program *much* slower.\n"
             "    Enable path checking mode (only check for target binary):\n"
             "         -y <path to target binary>\n"
             "         -z\n"
-            "         NOTE: uses ptrace, enabling this makes your "
-            "program *much* slower.\n"
+            "         NOTE: uses ptrace, but only stops the program at execs\n"
+            "         and at the filtered system calls of the target binary\n"
+            "         and of what it runs (all of them with -t).\n"
             "         NOTE: -z assumes prog as path\n"
+            "    Use the seccomp user notification fd instead of ptrace for\n"
+            "    the modes above (much faster, requires Linux >= 5.8):\n"
+            "         -u\n"
+            "    Count how many times each system call was stubbed, in a file\n"
+            "    kept up to date with one '<syscall number> <hits>' line per\n"
+            "    system call:\n"
+            "         -c <output file>\n"
+            "         NOTE: uses the user notification fd (or ptrace), the\n"
+            "         kernel cannot count for us.\n"
+            "    Discovery mode: record the system calls of the program (and\n"
+            "    of its children) in a file, instead of stubbing them:\n"
+            "         -D <output file>\n"
+            "         -a <syscall number>:<parameter position>\n"
+            "         -s <syscall number>:<path pointer position>\n"
+            "         NOTE: -a and -s also record the values of a parameter\n"
+            "         NOTE: not compatible with -c, -e, -n, -p and -t\n"
             "    Enable debug output:\n"
             "         -d\n"
             "    Enable quiet output (disables warnings):\n"
@@ -461,8 +1289,10 @@ usage(char *name)
             "  (7) stub read, but only for binary /usr/bin/red if the program forks\n"
             "         %s -e 38  -y /usr/bin/red -n 1 0 /usr/bin/blue ./secret.txt\n"
             "  (8) stub read, but only for binary /usr/bin/blue if the program forks\n"
-            "         %s -e 38  -z -n 1 0 /usr/bin/blue ./secret.txt\n",
-            name, name, name, name, name, name, name, name, name);
+            "         %s -e 38  -z -n 1 0 /usr/bin/blue ./secret.txt\n"
+            "  (9) record the system calls, mmap flags and open() paths\n"
+            "         %s -D out.json -a 9:3 -s 2:0 /usr/bin/file ./file.txt\n",
+            name, name, name, name, name, name, name, name, name, name);
 }
 
 int
@@ -470,26 +1300,27 @@ main(int argc, char **argv)
 {
     char *evalue = NULL;
     char *nvalue = NULL;
-    int c, sysnum, errno, *syscalls, status;
+    int c, sysnum = 0, f_errno = 0, *syscalls, status;
     int flags = 0; /* make sure to zero initialize */
 
     /* only valid with flags = DO_PARTIALSTUB or DO_PATHSTUB */
     int ptrace_pos = 0;
 
     /* only valid with flags = DO_PARTIALSTUB */
-    int ptrace_val = 0;
+    unsigned long ptrace_val = 0;
 
     /* only valid with flags = DO_PATHSTUB */
     char *ptrace_str = 0x0;
 
+    struct sock_fprog prog;
     pid_t pid;
 
-    if (argc < 5) {
+    if (argc < 4) {
         usage(argv[0]);
         exit(EXIT_FAILURE);
     }
 
-    while ((c = getopt (argc, argv, "qzdy:p:e:n:t:")) != -1) {
+    while ((c = getopt (argc, argv, "qzdlPuy:p:e:n:t:D:a:s:c:")) != -1) {
         switch (c)
         {
             case 't':
@@ -526,7 +1357,7 @@ main(int argc, char **argv)
                 }
 
                 if (optind < argc && *argv[optind] != '-') {
-                    ptrace_val = strtol(argv[optind], NULL, 0);
+                    ptrace_val = strtoul(argv[optind], NULL, 0);
                     optind++;
                 } else {
                     error ("-p option requires TWO arguments "
@@ -546,7 +1377,7 @@ main(int argc, char **argv)
                 if (strcmp(evalue, "crash") == 0) {
 		    SETF(flags, DO_CRASH);
 	        } else {
-                    errno = strtol(evalue, NULL, 0);
+                    f_errno = strtol(evalue, NULL, 0);
 		    SETF(flags, DO_ERRNO);
 		}
                 break;
@@ -575,6 +1406,49 @@ main(int argc, char **argv)
             case 'q':
                 QUIET = 1;
 		break;
+            case 'u':
+		SETF(flags, DO_USERNOTIF);
+		break;
+            case 'D':
+		SETF(flags, DO_PTRACE);
+		SETF(flags, DO_DISCOVER);
+
+                DISCOVERY_OUT = fopen(optarg, "we");
+                if (DISCOVERY_OUT == NULL) {
+                    perror("fopen");
+                    exit(EXIT_FAILURE);
+                }
+		break;
+            case 'c':
+		SETF(flags, DO_COUNT);
+
+                STATS_FD = open(optarg, O_WRONLY | O_CREAT | O_TRUNC | O_CLOEXEC, 0644);
+                if (STATS_FD == -1) {
+                    perror("open");
+                    exit(EXIT_FAILURE);
+                }
+		break;
+            case 'a':
+            case 's':
+                if (NWATCHED == ARRAY_SIZE(WATCHED) ||
+                    sscanf(optarg, "%d:%d", &WATCHED[NWATCHED].nr,
+                           &WATCHED[NWATCHED].pos) != 2 ||
+                    WATCHED[NWATCHED].pos < 0 || WATCHED[NWATCHED].pos > 5) {
+                    error ("Invalid value '%s' passed to -%c.\n", optarg, c);
+                    usage(argv[0]);
+                    exit(EXIT_FAILURE);
+                }
+                WATCHED[NWATCHED].is_path = (c == 's');
+                NWATCHED++;
+		break;
+            case 'l':
+                /* undocumented, for src/bench/ */
+                LINEAR_FILTER = 1;
+		break;
+            case 'P':
+                /* undocumented, for src/bench/ */
+                PEEKDATA_STRINGS = 1;
+		break;
             case '?':
 		if (optopt == 'e' || optopt == 'n') {
                     error ("Option -%c requires an argument.\n", optopt);
@@ -594,6 +1468,13 @@ main(int argc, char **argv)
         warning("quiet (-q) and debug (-d) incompatible, disabling quiet.\n");
     }
 
+    if (ISSET(flags, DO_DISCOVER) &&
+        (sysnum || ISSET(flags, DO_ERRNO | DO_CRASH | DO_PARTIALSTUB |
+                         DO_PATHSTUB | DO_COUNT))) {
+        error("Discovery mode (-D) not compatible with -c, -e, -n, -p and -t.\n");
+        exit(EXIT_FAILURE);
+    }
+
     if (argc < optind + sysnum + 1 /* a mandatory binary path */) {
         error("Error, not enough syscall numbers supplied "
               "(definitely not %d!).\n", sysnum);
@@ -605,12 +1486,133 @@ main(int argc, char **argv)
         syscalls[i] = strtol(argv[i + optind], NULL, 0);
     }
 
+    if (ISSET(flags, DO_COUNT))
+        stats_init(sysnum, syscalls);
+
     if (ISSET(flags, DO_CHECKPATH)) {
-        //realpath(EXECUTABLE_PATH, EXECUTABLE_PATH);
+        /* compared with /proc/<pid>/exe */
+        char resolved[PATH_MAX + 1];
+
+        /* -z: the target binary is prog itself */
+        if (EXECUTABLE_PATH[0] == 0)
+            strncpy(EXECUTABLE_PATH, argv[optind + sysnum], PATH_MAX);
+        if (realpath(EXECUTABLE_PATH, resolved) != NULL)
+            strcpy(EXECUTABLE_PATH, resolved);
         warning("Path checking mode enabled, "
             "I will only check for binary %s\n", EXECUTABLE_PATH);
     }
 
+    if (ISSET(flags, DO_PARTIALSTUB) && sysnum > 1) {
+        error("Error, several system calls declared (%d), "
+              "but -p option only compatible with one at a time.", sysnum);
+        exit(EXIT_FAILURE);
+    }
+
+    /* the filter can compare integer arguments on its own, we only need
+     * to follow the program to look at paths */
+    if (ISSET(flags, DO_PARTIALSTUB) && !ISSET(flags, DO_CHECKPATH))
+        flags &= ~DO_PTRACE;
+
+    /* a filter that stubs on its own does not tell anyone: to count, hand
+     * the stubbed calls to a supervisor (notifications if possible) */
+    if (ISSET(flags, DO_COUNT) && !ISSET(flags, DO_PTRACE))
+        SETF(flags, DO_PTRACE | DO_USERNOTIF);
+
+    /* path checking only: rather than stopping every process at every
+     * filtered system call, only stop them at execs, and give the filter to
+     * those that run the target binary. The filter still defers to us:
+     * whatever they exec or spawn later inherits it, and is only stubbed
+     * if it runs the target binary too (see ptracer_check_path_cached()) */
+    if (ISSET(flags, DO_CHECKPATH) && !ISSET(flags, DO_PATHSTUB) &&
+        !ISSET(flags, DO_DISCOVER)) {
+        int inject_flags = flags & ~DO_USERNOTIF;
+
+        SETF(flags, DO_INJECT);
+        if (ISSET(flags, DO_PARTIALSTUB) ?
+            build_arg_filter(syscalls[0], ptrace_pos, ptrace_val,
+                             inject_flags, f_errno, &INJECT_PROG) :
+            build_filter(sysnum, syscalls, inject_flags, f_errno, &INJECT_PROG))
+            exit(EXIT_FAILURE);
+    }
+
+    if (ISSET(flags, DO_USERNOTIF) &&
+        (!ISSET(flags, DO_PTRACE) || ISSET(flags, DO_DISCOVER | DO_INJECT))) {
+        /* nothing to supervise, or we need the registers anyway */
+        flags &= ~DO_USERNOTIF;
+    } else if (ISSET(flags, DO_USERNOTIF) &&
+               notif_deadlocks(sysnum, syscalls)) {
+        /* the child calls these after installing the filter, before we
+         * can answer its notifications */
+        warning("Cannot use the user notification fd for sendmsg and "
+                "execve, falling back to ptrace.\n");
+        flags &= ~DO_USERNOTIF;
+    } else if (ISSET(flags, DO_USERNOTIF)) {
+        flags &= ~DO_PTRACE;
+    }
+
+    if (ISSET(flags, DO_USERNOTIF)) {
+        int sockets[2], listener;
+
+        if (sysnum > 1 && ISSET(flags, DO_PARTIALSTUB | DO_PATHSTUB)) {
+            error("Error, several system calls declared (%d), "
+                  "but -u option only compatible with one at a time.", sysnum);
+            exit(EXIT_FAILURE);
+        }
+
+        if (socketpair(AF_UNIX, SOCK_STREAM | SOCK_CLOEXEC, 0, sockets)) {
+            perror("socketpair");
+            exit(EXIT_FAILURE);
+        }
+
+        debug("Running in user notification mode, about to fork().\n");
+        pid = fork();
+        if (pid == -1) {
+            perror("fork");
+            exit(EXIT_FAILURE);
+        } else if (pid != 0) {
+            /* parent = supervisor */
+            close(sockets[1]);
+            listener = recv_fd(sockets[0]);
+            close(sockets[0]);
+            if (listener < 0) {
+                error("Error, could not get the listener fd from the child.\n");
+                waitpid(pid, &status, 0);
+                exit(EXIT_FAILURE);
+            }
+
+            status = notif_loop(pid, listener, syscalls[0], ptrace_pos,
+                                ptrace_val, ptrace_str, flags, f_errno);
+            exit(status < 0 ? EXIT_FAILURE : status);
+        }
+
+        /* child = supervised, as with ptrace (PTRACE_O_EXITKILL) it should
+         * not survive the supervisor */
+        close(sockets[0]);
+        prctl(PR_SET_PDEATHSIG, SIGKILL);
+
+        if (prctl(PR_SET_NO_NEW_PRIVS, 1, 0, 0, 0)) {
+            perror("prctl");
+            exit(EXIT_FAILURE);
+        }
+
+        if (ISSET(flags, DO_PARTIALSTUB) ?
+            build_arg_filter(syscalls[0], ptrace_pos, ptrace_val, flags, f_errno, &prog) :
+            build_filter(sysnum, syscalls, flags, f_errno, &prog))
+            exit(EXIT_FAILURE);
+        listener = install_filter(&prog, flags);
+        if (listener < 0)
+            exit(EXIT_FAILURE);
+
+        /* from now on, only sendmsg and execve: any other system call could
+         * be the one we filter, and nobody would answer yet */
+        if (send_fd(sockets[1], listener))
+            exit(EXIT_FAILURE);
+
+        execv(argv[sysnum + optind], &argv[sysnum + optind]);
+        perror("execv");
+        exit(EXIT_FAILURE);
+    }
+
     /* if we're going to use ptrace, fork and setup tracing. */
     if (ISSET(flags, DO_PTRACE)) {
         if (ISSET(flags, DO_PATHSTUB)) {
@@ -624,6 +1626,10 @@ main(int argc, char **argv)
 	} else if (pid != 0) {
 	    /* parent = tracer */
             waitpid(pid, &status, 0); /* sync execv */
+            if (ISSET(flags, DO_INJECT) && ptracer_handle_exec(pid, flags)) {
+                kill(pid, SIGKILL);
+                exit(EXIT_FAILURE);
+            }
 	    ptrace(PTRACE_SETOPTIONS, pid, 0,
                 /* connection with seccomp */
                 PTRACE_O_TRACESECCOMP |
@@ -640,17 +1646,26 @@ main(int argc, char **argv)
             );
 	    ptrace(PTRACE_CONT, pid, 0, 0);
 
-	    if (sysnum > 1) {
+	    if (sysnum > 1 && ISSET(flags, DO_PARTIALSTUB | DO_PATHSTUB) &&
+                !ISSET(flags, DO_INJECT)) {
                 error("Error, several system calls declared (%d), "
                       "but ptrace option only compatible with one at a time.", sysnum);
                 exit(EXIT_FAILURE);
             }
-            ptracer_loop(syscalls[0], ptrace_pos, ptrace_val, ptrace_str, flags, errno);
-            exit(EXIT_SUCCESS);
+            status = ptracer_loop(pid, sysnum ? syscalls[0] : -1, ptrace_pos, ptrace_val,
+                                  ptrace_str, flags, f_errno);
+            exit(status < 0 ? EXIT_FAILURE : status);
 	} else {
 	    /* child = tracee */
             ptrace(PTRACE_TRACEME, 0, 0, 0);
             debug("Ptrace mode: child just started tracing.\n");
+            if (!ISSET(flags, DO_INJECT)) {
+                /* the filtered system calls (all of them in discovery
+                 * mode) are traced from the filter on, execve included:
+                 * wait for the tracer to set PTRACE_O_TRACESECCOMP,
+                 * otherwise they fail with ENOSYS */
+                raise(SIGSTOP);
+            }
 	}
     }
 
@@ -659,7 +1674,16 @@ main(int argc, char **argv)
         exit(EXIT_FAILURE);
     }
 
-    if (install_filter(sysnum, syscalls, flags, errno))
+    if (ISSET(flags, DO_INJECT)) {
+        /* the tracer installs it in the target binary only */
+    } else if (ISSET(flags, DO_PARTIALSTUB)) {
+        if (build_arg_filter(syscalls[0], ptrace_pos, ptrace_val, flags, f_errno, &prog))
+            exit(EXIT_FAILURE);
+    } else if (build_filter(sysnum, syscalls, flags, f_errno, &prog)) {
+        exit(EXIT_FAILURE);
+    }
+
+    if (!ISSET(flags, DO_INJECT) && install_filter(&prog, flags) < 0)
         exit(EXIT_FAILURE);
 
     debug("Alright, execv-ing now.\n");